@@ -0,0 +1,201 @@
+"""
+Fast-forwarding of simple counting loops, for the accelerated engine of
+runner.Runner. A loop here is a straight run of ADD, SUB, LDA and STA ending
+either in a BRZ/BRP back to its start, or in a BRZ/BRP out of the loop
+followed by a BRA back to its start. When every value the loop changes goes
+up or down by the same amount each time round, the number of times round
+before it exits can be worked out directly.
+"""
+import math
+
+import compiler
+
+
+# Exit conditions, on the accumulator when the loop's conditional branch is reached
+def _is_zero(value):
+    return value == 0
+
+
+def _is_nonzero(value):
+    return value != 0
+
+
+def _is_positive(value):
+    return value < 500
+
+
+def _is_negative(value):
+    return value >= 500
+
+
+def first_exit(start, step, condition):
+    """
+    The first k >= 0 for which condition holds of (start + k * step) % 1000,
+    or None if it never does.
+    """
+    if condition(start):
+        return 0
+    step %= 1000
+    if step == 0:
+        return None
+    if condition is _is_nonzero:
+        return 1
+    if condition is _is_zero:
+        gcd = math.gcd(step, 1000)
+        if -start % gcd:
+            return None
+        modulus = 1000 // gcd
+        return (-start // gcd) * pow(step // gcd, -1, modulus) % modulus
+    # Half of the values are positive, and a step can't go further than half way round, so it can't be jumped over
+    low = 0 if condition is _is_positive else 500
+    if step < 500:
+        return -(-((low - start) % 1000) // step)
+    return -(-((start - low - 499) % 1000) // (1000 - step))
+
+
+class Loop(compiler.Block):
+    # Stale in the same way as a compiled block, once any of its instructions has been overwritten
+    pass
+
+
+def describe(code, exit_index):
+    """
+    Work out what one time round a loop does. Values are (variable, offset)
+    pairs, variables being "acc", an address the loop stores to, or None for a
+    constant, and offsets tuples of (sign, address) of the cells it doesn't
+    change that are added on. Returns (new values of the variables, value
+    tested by the conditional branch), or None if the loop can't be described
+    like this.
+    """
+    written = {instruction % 100 for instruction in code[:exit_index] if instruction // 100 == 3}
+    values = {"acc": ("acc", ())}
+    test = None
+
+    def read(address):
+        if address in values:
+            return values[address]
+        return (address, ()) if address in written else (None, ((1, address),))
+
+    for index, instruction in enumerate(code):
+        op, addr = divmod(instruction, 100)
+        acc = values["acc"]
+        if index == exit_index:
+            test = acc
+        elif op == 1:  # ADD
+            value = read(addr)
+            if acc[0] is not None and value[0] is not None:
+                return None
+            values["acc"] = (acc[0] if value[0] is None else value[0], acc[1] + value[1])
+        elif op == 2:  # SUB
+            value = read(addr)
+            if value[0] is not None:
+                return None
+            values["acc"] = (acc[0], acc[1] + tuple((-sign, address) for sign, address in value[1]))
+        elif op == 3:  # STA
+            values[addr] = acc
+        elif op == 5:  # LDA
+            values["acc"] = read(addr)
+
+    updates = {variable: values.get(variable, (variable, ())) for variable in written | {"acc"}}
+    for variable, (source, offset) in updates.items():
+        # Everything has to count up or down, be a copy of something that does, or be set to a constant
+        if source is not None and source != variable and updates[source][0] != source:
+            return None
+    if test[0] is not None and updates[test[0]][0] != test[0]:
+        return None
+    return updates, test
+
+
+def compile_loop(cells, start, end, exit_index, condition):
+    """
+    Compile a fast-forwarder for the loop from start to the branch back at
+    end. The returned Loop's function takes (cells, accumulator, budget), goes
+    round the loop as many times as it can without leaving it or using more
+    than budget steps, and returns (accumulator, steps executed). The time
+    round in which the loop is left is left to be executed normally. Returns
+    None if the loop can't be fast-forwarded.
+    """
+    code = cells[start:end + 1]
+    description = describe(code, exit_index)
+    if description is None:
+        return None
+    updates, (variable, offset) = description
+
+    def name(variable):
+        return "acc" if variable == "acc" else "cells[{}]".format(variable)
+
+    def terms(offset):
+        return "".join(" {} cells[{}]".format("+" if sign > 0 else "-", address) for sign, address in offset)
+
+    def total(offset):
+        # terms(offset) on its own
+        text = terms(offset)
+        if not text:
+            return "0"
+        return text[3:] if text[1] == "+" else "-" + text[3:]
+
+    def step(variable):
+        return "(" + total(updates[variable][1]) + ")"
+
+    length = len(code)
+    lines = ["def loop_{:03}(cells, acc, budget):".format(start)]
+    if variable is None:
+        lines.append("    iterations = first_exit(({}) % 1000, 0, condition)".format(total(offset)))
+    else:
+        lines.append("    iterations = first_exit(({}{}) % 1000, {}, condition)".format(
+            name(variable), terms(offset), step(variable)))
+    lines.append("    if iterations is None:")
+    lines.append("        if budget >= 1 << 62:")
+    # Never leaves and nothing to stop it, so there is no shortcut to take
+    lines.append("            return acc, 0")
+    lines.append("        iterations = budget // {}".format(length))
+    lines.append("    iterations = min(iterations, budget // {})".format(length))
+    # Going round once is cheaper done normally
+    lines.append("    if iterations < 2:")
+    lines.append("        return acc, 0")
+    targets = sorted(updates, key=str)
+    for index, target in enumerate(targets):
+        source, offset = updates[target]
+        if source is None:
+            value = total(offset)
+        elif source == target:
+            value = "{} + iterations * {}".format(name(target), step(target))
+        else:
+            value = "{} + (iterations - 1) * {}{}".format(name(source), step(source), terms(offset))
+        lines.append("    value_{} = ({}) % 1000".format(index, value))
+    for index, target in enumerate(targets):
+        lines.append("    {} = value_{}".format(name(target), index))
+    lines.append("    return acc, iterations * {}".format(length))
+
+    source = "\n".join(lines) + "\n"
+    namespace = {"first_exit": first_exit, "condition": condition}
+    exec(compile(source, "<loop {:03}>".format(start), "exec"), namespace)
+    return Loop(start, code, source, namespace["loop_{:03}".format(start)])
+
+
+def find_loops(cells):
+    """Find the loops that can be fast-forwarded, by start address"""
+    loops = {}
+    for end, instruction in enumerate(cells):
+        op, start = divmod(instruction, 100)
+        if op not in (6, 7, 8) or start > end or start in loops:
+            continue
+        if op == 6:
+            # BRA back, with a conditional branch out just before it
+            if end == start or cells[end - 1] // 100 not in (7, 8) or start <= cells[end - 1] % 100 <= end:
+                continue
+            exit_index = end - 1 - start
+            condition = _is_zero if cells[end - 1] // 100 == 7 else _is_positive
+        else:
+            exit_index = end - start
+            condition = _is_nonzero if op == 7 else _is_negative
+        body = cells[start:start + exit_index]
+        if not all(i // 100 in (1, 2, 3, 5) for i in body):
+            continue
+        # A loop that stores into itself isn't going round the same way each time
+        if any(i // 100 == 3 and start <= i % 100 <= end for i in body):
+            continue
+        loop = compile_loop(cells, start, end, exit_index, condition)
+        if loop is not None:
+            loops[start] = loop
+    return loops
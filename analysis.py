@@ -0,0 +1,141 @@
+"""
+Static analysis of assembled programs. The instructions are split into basic
+blocks, which are joined up into a control flow graph once, and the rest is
+worked out on the graph in time linear in its size. Code that modifies itself
+isn't taken into account.
+"""
+import collections
+
+# Leaving the program: HLT, running off the end of it into empty memory, or an instruction that can't be run
+EXIT = -1
+
+# start and end are addresses, successors are the starts of the blocks that can run next, or EXIT
+Block = collections.namedtuple("Block", ["start", "end", "successors"])
+
+
+def next_addresses(address, instruction, length):
+    """The addresses that can be run after the instruction at address, in a program of length instructions"""
+    def inside(target):
+        return target if target < length else EXIT
+
+    if instruction is None:
+        # An argument that couldn't be resolved, so it isn't known where it goes. Falling through keeps the rest of
+        # the program reachable while it is being written, and leaving keeps it from looking like an endless loop.
+        return [inside(address + 1), EXIT]
+    if not 0 <= instruction <= 999:
+        return [EXIT]
+    op, target = divmod(instruction, 100)
+    if op == 6:  # BRA
+        return [inside(target)]
+    elif op in (7, 8):  # BRZ, BRP
+        return [inside(target), inside(address + 1)]
+    elif op in (1, 2, 3, 5) or instruction in (901, 902):
+        return [inside(address + 1)]
+    # HLT and invalid instructions
+    return [EXIT]
+
+
+class Analysis:
+    """
+    Made from the Mnemonic tokens of a program, in address order. After
+    making it:
+        leaders              the addresses that start blocks
+        blocks               Blocks by start address
+        reachable            the starts of the blocks that can be run
+        unreachable          the addresses of instructions (not DATs) that can't be run
+        endless_loops        lists of the addresses in each loop that can be
+                             run and can't be left, leaving out data that only
+                             happens to look like one
+    """
+    def __init__(self, instructions):
+        self.code = [instr.machine_instruction() for instr in instructions]
+        length = len(self.code)
+
+        self.leaders = {0} if length else set()
+        for address, instruction in enumerate(self.code):
+            following = next_addresses(address, instruction, length)
+            if following != [address + 1]:
+                self.leaders.update(target for target in following if target != EXIT)
+                if address + 1 < length:
+                    self.leaders.add(address + 1)
+
+        self.blocks = {}
+        starts = sorted(self.leaders)
+        for start, end in zip(starts, starts[1:] + [length]):
+            self.blocks[start] = Block(start, end, next_addresses(end - 1, self.code[end - 1], length))
+
+        self.reachable = self.find_reachable()
+        self.unreachable = [address for block in self.blocks.values() if block.start not in self.reachable
+                            for address in range(block.start, block.end) if instructions[address].mnemonic != "DAT"]
+        self.endless_loops = self.find_endless_loops(
+            {address for address, instr in enumerate(instructions) if instr.mnemonic == "DAT"})
+
+    def find_reachable(self):
+        if not self.blocks:
+            return set()
+        reachable = {0}
+        todo = [0]
+        while todo:
+            for successor in self.blocks[todo.pop()].successors:
+                if successor != EXIT and successor not in reachable:
+                    reachable.add(successor)
+                    todo.append(successor)
+        return reachable
+
+    def components(self):
+        """The strongly connected components of the blocks (Tarjan's algorithm, without recursion)"""
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in self.blocks:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.blocks[root].successors))]
+            while work:
+                node, successors = work[-1]
+                for successor in successors:
+                    if successor == EXIT:
+                        continue
+                    if successor not in index:
+                        index[successor] = lowlink[successor] = len(index)
+                        stack.append(successor)
+                        on_stack.add(successor)
+                        work.append((successor, iter(self.blocks[successor].successors)))
+                        break
+                    elif successor in on_stack:
+                        lowlink[node] = min(lowlink[node], index[successor])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        return components
+
+    def find_endless_loops(self, dats):
+        loops = []
+        for component in self.components():
+            if component[0] not in self.reachable:
+                continue
+            if all(address in dats for start in component for address in range(start, self.blocks[start].end)):
+                continue
+            members = set(component)
+            successors = [successor for start in component for successor in self.blocks[start].successors]
+            cyclic = len(component) > 1 or component[0] in successors
+            if cyclic and all(successor in members for successor in successors):
+                loops.append([address for start in sorted(component)
+                              for address in range(start, self.blocks[start].end)])
+        return loops
@@ -1,7 +1,11 @@
 import abc
+import bisect
+import collections
+import itertools
 import string
 import re
 
+import analysis
 import problems
 
 # Tuples in the form (numeric code, short description, long description)
@@ -32,6 +36,13 @@ MNEMONIC_INFO = {
 }
 
 
+# Ids for tokens, so that they can be found again from a tag name and the like
+_token_ids = itertools.count()
+
+# A comment, a word (letters, digits and -) or anything else in between
+TOKEN_RE = re.compile(r"#.*|(?:[^\W_]|-)+|(?:[^\w#-]|_)+")
+
+
 class Position:
     def __init__(self, lineno, start_index, end_index):
         self.lineno = lineno
@@ -70,6 +81,13 @@ class Token:
         self.position = position
         self.style = style
         self.problems = problems or []
+        self.id = next(_token_ids)
+        # Problems found from the token's own line, the rest come from the whole program
+        self.line_problems = len(self.problems)
+
+    def reset(self):
+        """Forget what was found out about the token from the rest of the program"""
+        del self.problems[self.line_problems:]
 
     @property
     def in_error(self):
@@ -102,6 +120,11 @@ class Mnemonic(InteractiveToken):
         self.arg = None
         self.address = None
 
+    def reset(self):
+        super().reset()
+        self.arg = None
+        self.address = None
+
     def link_arg(self, arg):
         self.arg = arg
 
@@ -156,6 +179,11 @@ class Label(InteractiveToken):
         self.address = None
         self.refs = []
 
+    def reset(self):
+        super().reset()
+        self.address = None
+        self.refs = []
+
     def set_interactive(self, tooltip):
         tooltip.type("label definition")
         tooltip.value(self.text)
@@ -182,6 +210,10 @@ class LabelRef(Argument):
         super().__init__(*args, style="labelref", **kwargs)
         self.label = None
 
+    def reset(self):
+        super().reset()
+        self.label = None
+
     def link_label(self, label):
         self.label = label
         label.refs.append(self)
@@ -224,103 +256,201 @@ class Number(Argument):
         tooltip.newline()
 
 
+class ProblemIndex:
+    """
+    The problems found by a parse, as (token, problem) entries in the order
+    of the tokens, indexed by category ("error" or "warning"), line and class.
+    """
+    def __init__(self, tokens):
+        self.entries = [(token, problem) for token in tokens for problem in token.problems]
+        self.by_cat = collections.defaultdict(list)
+        self.by_line = collections.defaultdict(list)
+        self.by_class = collections.defaultdict(list)
+        for index, (_, problem) in enumerate(self.entries):
+            self.by_cat[problem.cat].append(index)
+            self.by_line[problem.position.lineno].append(index)
+            self.by_class[problem.__class__].append(index)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (problem for _, problem in self.entries)
+
+    def _indices(self, cat, lineno, kind):
+        found = []
+        if cat is not None:
+            found.append(self.by_cat.get(cat, []))
+        if lineno is not None:
+            found.append(self.by_line.get(lineno, []))
+        if kind is not None:
+            found.append(sorted(index for cls, indices in self.by_class.items() if issubclass(cls, kind)
+                                for index in indices))
+        return found
+
+    def select(self, cat=None, lineno=None, kind=None):
+        """Iterate over the entries of category cat, on line lineno and of class kind (or a subclass of it)"""
+        found = self._indices(cat, lineno, kind)
+        if not found:
+            yield from self.entries
+            return
+        shortest = min(found, key=len)
+        others = [set(indices) for indices in found if indices is not shortest]
+        for index in shortest:
+            if all(index in indices for indices in others):
+                yield self.entries[index]
+
+    def count(self, cat=None, lineno=None, kind=None):
+        found = self._indices(cat, lineno, kind)
+        if len(found) <= 1:
+            return len(found[0]) if found else len(self.entries)
+        return sum(1 for _ in self.select(cat, lineno, kind))
+
+    def summary(self):
+        errors, warnings = self.count("error"), self.count("warning")
+        return "{} error{}, {} warning{}".format(errors, "" if errors == 1 else "s",
+                                                 warnings, "" if warnings == 1 else "s")
+
+
 class Assembler:
+    """
+    Lines are tokenised and parsed on their own and kept, so that changing
+    the code only redoes the lines that changed, and then the checks that
+    need the whole program.
+    """
     def __init__(self):
-        self.tokenised = self.parsed = self.assembled = False
+        self.code = []
+        self.tokenised = self.lines_parsed = self.parsed = self.assembled = False
+
+    @property
+    def raw_code(self):
+        return "\n".join(self.code)
 
     def update_code(self, code):
-        self.raw_code = code
-        self.code = code.split("\n")
-        self.tokenised = self.parsed = self.assembled = False
+        """Change the code to code, redoing only the lines that differ from the current code"""
+        lines = code.split("\n")
+        old = self.code
+        shortest = min(len(lines), len(old))
+        start = 0
+        while start < shortest and lines[start] == old[start]:
+            start += 1
+        end = 0
+        while end < shortest - start and lines[-1 - end] == old[-1 - end]:
+            end += 1
+        self.update_lines(start, len(old) - end, lines[start:len(lines) - end])
+
+    def update_lines(self, start, end, lines):
+        """Replace lines start up to end of the code with lines"""
+        self.code[start:end] = lines
+        if self.tokenised:
+            self.tokenised_code[start:end] = [self.tokenise_line(line) for line in lines]
+        if self.lines_parsed:
+            for line in self.parsed_code[start:end]:
+                for token in line:
+                    del self.token_index[token.id]
+            parsed_lines = [self.parse_line(lineno, tokens)
+                            for lineno, tokens in enumerate(self.tokenised_code[start:start + len(lines)], start)]
+            self.parsed_code[start:end] = parsed_lines
+            self.token_starts[start:end] = self.index_lines(parsed_lines)
+            if len(lines) != end - start:
+                # Renumber the lines that moved
+                for lineno in range(start + len(lines), len(self.parsed_code)):
+                    for token in self.parsed_code[lineno]:
+                        token.position.lineno = lineno
+        if start != end or lines:
+            self.parsed = self.assembled = False
 
     @property
     def tokens(self):
-        return [token for line in self.parsed_code for token in line]
+        self.parse()
+        return self._tokens
+
+    def tokenise_line(self, line):
+        """Split a line into (text, start index, end index) tokens"""
+        if line.endswith("\n"):
+            line = line[:-1]
+        return [(match.group(), match.start(), match.end()) for match in TOKEN_RE.finditer(line)]
 
     def tokenise(self):
         if self.tokenised:
             return self.tokenised_code
-        self.tokenised_code = []
-        for line in self.code:
-            if line.endswith("\n"):
-                line = line[:-1]
-            line = list(line)
-            tok_line = []
-            c = line.pop(0) if line else ""
-            while c:
-                if c == "#":
-                    tok_line.append("".join([c] + line))
-                    break
-                elif c.isalnum() or c == "-":
-                    building = []
-                    while (c.isalnum() or c == "-"):
-                        building.append(c)
-                        c = line.pop(0) if line else ""
-                    tok_line.append("".join(building))
-                else:
-                    building = []
-                    while c and not c.isalnum() and c not in "-#":
-                        building.append(c)
-                        c = line.pop(0) if line else ""
-                    tok_line.append("".join(building))
-            self.tokenised_code.append(tok_line)
+        self.tokenised_code = [self.tokenise_line(line) for line in self.code]
         self.tokenised = True
         return self.tokenised_code
 
+    def parse_line(self, lineno, line):
+        """Parse the tokens of a line, finding the problems that can be seen from the line alone"""
+        parsed_line = []
+        found_label = found_mnem = found_arg = False
+        for token, start_index, end_index in line:
+            position = Position(lineno, start_index, end_index)
+            tok_problems = []
+            if token and (token[0].isalnum() or token[0] == "-"):
+                if token.upper() in MNEMONIC_INFO:
+                    if found_mnem:
+                        tok_problems.append(problems.SyntaxError("Multiple mnemonics on one line", position))
+                    if not token.isupper():
+                        tok_problems.append(problems.StyleWarning("Mnemonics should be uppercase", position))
+                    parsed_line.append(Mnemonic(token, position, problems=tok_problems))
+                    found_mnem = True
+                elif found_mnem:
+                    if found_arg:
+                        tok_problems.append(problems.SyntaxError("Multiple arguments for mnemonic", position))
+                    try:
+                        int(token)
+                    except ValueError:
+                        parsed_line.append(LabelRef(token, position, problems=tok_problems))
+                    else:
+                        if int(token) > 499:
+                            tok_problems.append(problems.SemanticError("Number too large (> 499)", position))
+                        if int(token) < -500:
+                            tok_problems.append(problems.SemanticError("Number too small (< -500)", position))
+                        parsed_line.append(Number(token, position, problems=tok_problems))
+                    found_arg = True
+                else:
+                    if found_label:
+                        tok_problems.append(problems.SyntaxError("Multiple labels for one line", position))
+                    parsed_line.append(Label(token, position, problems=tok_problems))
+                    found_label = True
+            elif token.startswith("#"):
+                parsed_line.append(Comment(token, position, problems=tok_problems))
+            else:
+                parsed_line.append(Token(token, position, problems=tok_problems))
+        return parsed_line
+
+    def index_lines(self, lines):
+        """Add the tokens of the parsed lines to the index by id, returning the start indices of each line's tokens"""
+        starts = []
+        for line in lines:
+            for token in line:
+                self.token_index[token.id] = token
+            starts.append([token.position.start_index for token in line])
+        return starts
+
     def parse(self):
         if self.parsed:
             return self.parsed_code
         self.tokenise()
-        self.parsed_code = []
+        if self.lines_parsed:
+            for line in self.parsed_code:
+                for token in line:
+                    token.reset()
+        else:
+            self.parsed_code = [self.parse_line(lineno, line) for lineno, line in enumerate(self.tokenised_code)]
+            self.token_index = {}
+            self.token_starts = self.index_lines(self.parsed_code)
+            self.lines_parsed = True
+
         self.labels = {}
-        for lineno, line in enumerate(self.tokenised_code):
-            parsed_line = []
-            found_label = found_mnem = found_arg = False
-            start_index = end_index = 0
+        for line in self.parsed_code:
             for token in line:
-                start_index = end_index
-                end_index = start_index + len(token)
-                position = Position(lineno, start_index, end_index)
-                tok_problems = []
-                if token and (token[0].isalnum() or token[0] == "-"):
-                    if token.upper() in MNEMONIC_INFO:
-                        if found_mnem:
-                            tok_problems.append(problems.SyntaxError("Multiple mnemonics on one line", position))
-                        if not token.isupper():
-                            tok_problems.append(problems.StyleWarning("Mnemonics should be uppercase", position))
-                        parsed_line.append(Mnemonic(token, position, problems=tok_problems))
-                        found_mnem = True
-                    elif found_mnem:
-                        if found_arg:
-                            tok_problems.append(problems.SyntaxError("Multiple arguments for mnemonic", position))
-                        try:
-                            int(token)
-                        except ValueError:
-                            parsed_line.append(LabelRef(token, position, problems=tok_problems))
-                        else:
-                            if int(token) > 499:
-                                tok_problems.append(problems.SemanticError("Number too large (> 499)", position))
-                            if int(token) < -500:
-                                tok_problems.append(problems.SemanticError("Number too small (< -500)", position))
-                            parsed_line.append(Number(token, position, problems=tok_problems))
-                        found_arg = True
+                if isinstance(token, Label):
+                    if token.text in self.labels:
+                        linked_token = self.labels[token.text][1]
+                        token.problems.append(problems.SemanticError("Label already defined", token.position,
+                                                                     extra=("First defined", linked_token)))
                     else:
-                        if found_label:
-                            tok_problems.append(problems.SyntaxError("Multiple labels for one line", position))
-                        if token in self.labels:
-                            linked_token = self.labels[token][1]
-                            tok_problems.append(problems.SemanticError("Label already defined", position,
-                                                                       extra=("First defined", linked_token)))
-                        l = Label(token, position, problems=tok_problems)
-                        if token not in self.labels:
-                            self.labels[token] = (None, l)
-                        parsed_line.append(l)
-                        found_label = True
-                elif token.startswith("#"):
-                    parsed_line.append(Comment(token, position, problems=tok_problems))
-                else:
-                    parsed_line.append(Token(token, position, problems=tok_problems))
-            self.parsed_code.append(parsed_line)
+                        self.labels[token.text] = (None, token)
 
         # Check for missing labels etc. which can't be checked above
 
@@ -354,20 +484,20 @@ class Assembler:
 
         # Extra warnings
 
-        if self.tokens and not any(isinstance(token, Mnemonic) and token.mnemonic == "HLT" for token in self.tokens):
-            self.tokens[-1].problems.append(problems.RuntimeWarning("No HLT instruction", self.tokens[-1].position))
+        tokens = [token for line in self.parsed_code for token in line]
+        if tokens and not any(instr.mnemonic == "HLT" for instr in self.instructions):
+            tokens[-1].problems.append(problems.RuntimeWarning("No HLT instruction", tokens[-1].position))
 
-        for bra in filter(lambda tok: tok.mnemonic == "BRA", self.instructions):
-            if bra.arg and isinstance(bra.arg, (LabelRef, Number)) and bra.arg.resolve() is not None:
-                if bra.address < bra.arg.resolve():
-                    continue
-                for mnem in self.instructions[bra.arg.resolve():bra.address]:
-                    if mnem.mnemonic in ("BRP", "BRZ", "BRA"):
-                        break
-                else:
-                    bra.problems.append(problems.RuntimeWarning("Possible infinite loop", bra.position,
-                                                                extra=("Starting at",
-                                                                       self.instructions[bra.arg.resolve()])))
+        self.analysis = analysis.Analysis(self.instructions)
+
+        for loop in self.analysis.endless_loops:
+            last = self.instructions[loop[-1]]
+            last.problems.append(problems.RuntimeWarning("Possible infinite loop", last.position,
+                                                         extra=("Starting at", self.instructions[loop[0]])))
+
+        for address in self.analysis.unreachable:
+            instr = self.instructions[address]
+            instr.problems.append(problems.StyleWarning("Instruction can never be run", instr.position))
 
         for instr in filter(lambda tok: tok.mnemonic != "DAT", self.instructions):
             if instr.arg and isinstance(instr.arg, Number):
@@ -396,13 +526,16 @@ class Assembler:
                         msg = "{} will not {} a DAT instruction".format(instr.mnemonic, phrase)
                         instr.problems.append(problems.RuntimeWarning(msg, instr.position))
 
-        self.in_error = any(token.in_error for token in self.tokens)
+        self._tokens = tokens
+        self.problem_index = ProblemIndex(tokens)
+        self.in_error = bool(self.problem_index.count("error"))
         self.parsed = True
         return self.parsed_code
 
     @property
     def problems(self):
-        return sum((token.problems for token in self.tokens), [])
+        self.parse()
+        return list(self.problem_index)
 
     def assemble(self):
         if self.assembled:
@@ -418,18 +551,26 @@ class Assembler:
         return self.machine_code
 
     def get_token_at(self, row, col=None):
+        """
+        The token at a Position, or the token covering column col of line
+        row, or None if there isn't one.
+        """
         self.parse()
+        position = None
         if col is None and isinstance(row, Position):
-            line = self.parsed_code[row.lineno]
-            for token in line:
-                if token.position == row:
-                    return token
-        else:
-            line = self.parsed_code[row]
-            for token in line:
-                if token.position.start_index <= col < token.position.end_index:
-                    return token
-        return None
+            position, row, col = row, row.lineno, row.start_index
+        index = bisect.bisect_right(self.token_starts[row], col) - 1
+        if index < 0:
+            return None
+        token = self.parsed_code[row][index]
+        if position is not None:
+            return token if token.position == position else None
+        return token if col < token.position.end_index else None
+
+    def get_token_by_id(self, token_id):
+        """The token with the id, or None if it is no longer in the code"""
+        self.parse()
+        return self.token_index.get(token_id)
 
 
 if __name__ == "__main__":
@@ -449,7 +590,7 @@ if __name__ == "__main__":
 
     pprint.pprint(a.tokenised_code)
 
-    recode = "\n".join("".join(line) for line in a.tokenised_code)
+    recode = "\n".join("".join(token for token, _, _ in line) for line in a.tokenised_code)
     if recode != code:
         sys.stdout.writelines(d.compare(code.splitlines(keepends=True),
                                         recode.splitlines(keepends=True)))
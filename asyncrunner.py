@@ -0,0 +1,77 @@
+"""
+Runner for asyncio, so that many sessions can share one event loop. Programs
+run a chunk of steps at a time, giving the other sessions a turn in between,
+inputs are awaited from a queue and outputs are put on another.
+"""
+import asyncio
+
+import runner
+
+# Steps run before giving other sessions a turn
+CHUNK = 1000
+
+
+class AsyncRunner:
+    """
+    Feed inputs with give_input (or put them on self.inputs) and read outputs
+    from self.outputs, where None is put when a run finishes, or with
+    iter_outputs. max_steps is the session's budget of steps, counted from
+    the last load_code or reset.
+    """
+    def __init__(self, engine=runner.Engine.fast, max_steps=None, chunk=CHUNK, inputs=None, outputs=None):
+        self.runner = runner.Runner(None, engine=engine)
+        self.max_steps = max_steps
+        self.chunk = chunk
+        self.inputs = asyncio.Queue() if inputs is None else inputs
+        self.outputs = asyncio.Queue() if outputs is None else outputs
+
+    def load_code(self, assembler):
+        self.runner.load_code(assembler)
+
+    def reset(self):
+        self.runner.reset()
+
+    @property
+    def steps(self):
+        return self.runner.steps
+
+    @property
+    def halt_reason(self):
+        return self.runner.halt_reason
+
+    async def give_input(self, value):
+        await self.inputs.put(value)
+
+    async def run(self):
+        """
+        Run until HLT, a breakpoint or the end of the budget of steps, waiting
+        for inputs as they are needed. Returns the HaltReason, which is
+        HaltReason.step_limit if the budget ran out.
+        """
+        run = self.runner
+        reason = run.halt_reason
+        try:
+            while True:
+                if reason is runner.HaltReason.input:
+                    run.give_input(await self.inputs.get())
+                chunk = self.chunk if self.max_steps is None else min(self.chunk, self.max_steps - run.steps)
+                if chunk <= 0:
+                    return runner.HaltReason.step_limit
+                summary = run.run(max_steps=chunk)
+                for value in summary.outputs:
+                    await self.outputs.put(value)
+                reason = summary.halt_reason
+                if reason not in (runner.HaltReason.step_limit, runner.HaltReason.input):
+                    return reason
+                # Let everyone else have a go
+                await asyncio.sleep(0)
+        finally:
+            await self.outputs.put(None)
+
+    async def iter_outputs(self):
+        """Yield the values output until the end of the run"""
+        while True:
+            value = await self.outputs.get()
+            if value is None:
+                return
+            yield value
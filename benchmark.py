@@ -0,0 +1,331 @@
+"""
+Benchmarks of the assembler, the runner's engines and the refreshes of the
+run mode, written as JSON so that two runs can be compared.
+
+    python benchmark.py run [-o results.json] [-r repeats] [-k filter]
+    python benchmark.py compare old.json new.json [-t threshold]
+
+The run mode benchmarks need a display, and start Xvfb if there isn't one.
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import assembler
+import runner
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# Programs run to HLT, with the inputs they are given
+PROGRAMS = {"fib": ("hard/fib.lmc", [30]),
+            "primes": ("hard/primes.lmc", [2, 200]),
+            "multiply": ("medium/multiply.lmc", [17, 23])}
+
+# Sizes (in lines) of the generated sources
+GENERATED = (1000, 10000)
+
+# Stepped through by the run mode benchmarks, it counts and outputs for ever
+REFRESH_PROGRAM = """
+LOOP    LDA X
+        ADD ONE
+        STA X
+        OUT
+        BRA LOOP
+X       DAT
+ONE     DAT 1
+"""
+REFRESH_STEPS = 200
+
+FORMAT_VERSION = 1
+
+
+def percentile(ordered, percent):
+    # Nearest rank
+    return ordered[max(0, -(-len(ordered) * percent // 100) - 1)]
+
+
+def measure(function, repeat, setup=None):
+    """Time repeat calls of function(setup()), where setup isn't timed, returning the times in seconds"""
+    times = []
+    for _ in range(repeat):
+        state = None if setup is None else setup()
+        start = time.perf_counter()
+        function(state)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarise(times, work, unit):
+    """Percentiles of the times, and the rate at which work units were got through at the median"""
+    ordered = sorted(times)
+    median = percentile(ordered, 50)
+    return {"unit": unit,
+            "work": work,
+            "runs": len(times),
+            "mean": statistics.mean(times),
+            "min": ordered[0],
+            "p50": median,
+            "p90": percentile(ordered, 90),
+            "p99": percentile(ordered, 99),
+            "max": ordered[-1],
+            "per_second": work / median if median else None}
+
+
+def generate_source(lines):
+    """A program of about lines lines, of commented counting loops and their variables"""
+    out = []
+    block = 0
+    while len(out) < lines:
+        out.extend(["# Loop {}, counts COUNT{} down to zero".format(block, block),
+                    "LOOP{}   LDA COUNT{}".format(block, block),
+                    "        SUB ONE",
+                    "        STA COUNT{}".format(block),
+                    "        BRZ NEXT{}   # done".format(block),
+                    "        BRA LOOP{}".format(block),
+                    "NEXT{}   LDA TOTAL".format(block),
+                    "        ADD COUNT{}".format(block),
+                    "        STA TOTAL",
+                    "COUNT{}  DAT {}".format(block, block % 500),
+                    ""])
+        block += 1
+    out.extend(["        HLT", "ONE     DAT 1", "TOTAL   DAT"])
+    return "\n".join(out)
+
+
+def corpora():
+    """Sources to assemble, by name: all the examples together, and the generated ones"""
+    examples = []
+    for fname in sorted(glob.glob(os.path.join(EXAMPLES, "**", "*.lmc"), recursive=True)):
+        with open(fname) as f:
+            examples.append(f.read())
+    sources = {"examples": examples}
+    for lines in GENERATED:
+        sources["generated_{}".format(lines)] = [generate_source(lines)]
+    return sources
+
+
+def bench_assembler(repeat):
+    results = {}
+    for name, sources in corpora().items():
+        lines = sum(source.count("\n") + 1 for source in sources)
+
+        def fresh(stage):
+            # Assemblers with everything before stage already done
+            def setup():
+                assems = []
+                for source in sources:
+                    assem = assembler.Assembler()
+                    assem.update_code(source)
+                    if stage == "parse":
+                        assem.tokenise()
+                    elif stage == "assemble":
+                        assem.parse()
+                    assems.append(assem)
+                return assems
+            return setup
+
+        stages = ["tokenise", "parse"]
+        # Assembling stops straight away on errors, so timing it would be meaningless
+        if not any(assem.in_error for assem in fresh("assemble")()):
+            stages.append("assemble")
+        for stage in stages:
+            times = measure(lambda assems: [getattr(assem, stage)() for assem in assems], repeat, fresh(stage))
+            results["assembler.{}.{}".format(stage, name)] = summarise(times, lines, "lines")
+
+        if len(sources) == 1:
+            # Changing one line in the middle, as the code editor does after a keystroke
+            def edited():
+                assem = assembler.Assembler()
+                assem.update_code(sources[0])
+                assem.assemble()
+                code = assem.code[:]
+                code[len(code) // 2] += " # edited"
+                return assem, "\n".join(code)
+
+            times = measure(lambda state: (state[0].update_code(state[1]), state[0].assemble()), repeat, edited)
+            results["assembler.edit.{}".format(name)] = summarise(times, 1, "edits")
+    return results
+
+
+def bench_runner(repeat):
+    results = {}
+    for name, (fname, inputs) in PROGRAMS.items():
+        with open(os.path.join(EXAMPLES, fname)) as f:
+            assem = assembler.Assembler()
+            assem.update_code(f.read())
+        assem.assemble()
+        for engine in runner.Engine:
+            def setup():
+                run = runner.Runner(None, engine=engine, inputs=inputs)
+                run.load_code(assem)
+                return run
+
+            runs = []
+            times = measure(lambda run: runs.append(run) or run.run_to_hlt(), repeat, setup)
+            results["runner.{}.{}".format(name, engine.value)] = summarise(times, runs[0].steps, "instructions")
+    return results
+
+
+def virtual_display():
+    """
+    Make sure Tk has a display, starting Xvfb if there isn't one. Returns the
+    Xvfb process started, if one was, and raises RuntimeError if there is no
+    display to be had.
+    """
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        raise RuntimeError("no display, and Xvfb isn't installed")
+    number = 90 + os.getpid() % 100
+    process = subprocess.Popen([xvfb, ":{}".format(number), "-screen", "0", "1280x1024x24"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 10
+    while not os.path.exists("/tmp/.X11-unix/X{}".format(number)):
+        if process.poll() is not None or time.perf_counter() > deadline:
+            process.kill()
+            raise RuntimeError("Xvfb didn't start")
+        time.sleep(0.05)
+    os.environ["DISPLAY"] = ":{}".format(number)
+    return process
+
+
+def bench_runmode(repeat):
+    xvfb = virtual_display()
+    try:
+        import tkinter
+        import runmode
+        root = tkinter.Tk()
+        try:
+            mode = runmode.RunMode(root)
+            mode.grid(row=0, column=0, sticky=tkinter.NE + tkinter.SW)
+            assem = assembler.Assembler()
+            assem.update_code(REFRESH_PROGRAM)
+            mode.set_code(assem, None)
+            root.update()
+
+            def setup():
+                mode.reset()
+                root.update()
+
+            def steps(state):
+                for _ in range(REFRESH_STEPS):
+                    mode.next_step()
+                    root.update_idletasks()
+
+            def refresh(state):
+                mode.update_memory()
+                root.update_idletasks()
+
+            return {"runmode.next_step": summarise(measure(steps, repeat, setup), REFRESH_STEPS, "steps"),
+                    "runmode.update_memory": summarise(measure(refresh, repeat, setup), 1, "refreshes")}
+        finally:
+            root.destroy()
+    finally:
+        if xvfb is not None:
+            xvfb.kill()
+            xvfb.wait()
+
+
+BENCHMARKS = {"assembler": bench_assembler,
+              "runner": bench_runner,
+              "runmode": bench_runmode}
+
+
+def run_benchmarks(repeat=5, only=None):
+    results = {"version": FORMAT_VERSION,
+               "date": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "benchmarks": {},
+               "skipped": {}}
+    for name, bench in BENCHMARKS.items():
+        if only and only not in name:
+            continue
+        try:
+            results["benchmarks"].update(bench(repeat))
+        except (RuntimeError, ImportError) as e:
+            results["skipped"][name] = str(e)
+        except Exception as e:
+            # Tk raises TclError when it can't get at the display
+            if e.__class__.__name__ != "TclError":
+                raise
+            results["skipped"][name] = str(e)
+    return results
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare the median times of the benchmarks in both results. Returns the
+    lines of a report, and the names of those that got more than threshold
+    slower.
+    """
+    lines = ["{:<40} {:>12} {:>12} {:>8}".format("Benchmark", "Old p50", "New p50", "Change")]
+    regressions = []
+    for name in sorted(set(old["benchmarks"]) & set(new["benchmarks"])):
+        before, after = old["benchmarks"][name]["p50"], new["benchmarks"][name]["p50"]
+        change = after / before - 1 if before else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  SLOWER"
+        elif change < -threshold:
+            flag = "  faster"
+        lines.append("{:<40} {:>11.6f}s {:>11.6f}s {:>+7.1%}{}".format(name, before, after, change, flag))
+    for name in sorted(set(old["benchmarks"]) ^ set(new["benchmarks"])):
+        lines.append("{:<40} only in the {} results".format(name, "old" if name in old["benchmarks"] else "new"))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the assembler, runner and run mode")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="write the results to this file (default: stdout)")
+    run_parser.add_argument("-r", "--repeat", help="times to run each benchmark", type=int, default=5)
+    run_parser.add_argument("-k", "--only", help="only run the groups (assembler, runner, runmode) containing this")
+    compare_parser = commands.add_parser("compare", help="compare two sets of results")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("-t", "--threshold", help="slowdown counted as a regression (default: 0.1)",
+                                type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmarks(args.repeat, args.only)
+        for name, result in sorted(results["benchmarks"].items()):
+            print("{:<40} p50 {:>10.6f}s  {:>14,.0f} {}/s".format(name, result["p50"], result["per_second"] or 0,
+                                                                  result["unit"]), file=sys.stderr)
+        for name, reason in results["skipped"].items():
+            print("Skipped {}: {}".format(name, reason), file=sys.stderr)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        return 0
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        lines, regressions = compare(old, new, args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            print("{} regression{}".format(len(regressions), "" if len(regressions) == 1 else "s"))
+            return 1
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
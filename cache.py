@@ -0,0 +1,29 @@
+"""
+What the caches have in common: counting hits and misses, and closing them
+at the end of a with block.
+"""
+
+
+class Cache:
+    def __init__(self):
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def counted(self, found):
+        """Count found, None being a miss, and return it"""
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return "{} hits, {} misses".format(self.hits, self.misses)
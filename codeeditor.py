@@ -4,7 +4,6 @@ import functools
 import collections
 import assembler
 import runner
-import itertools
 import re
 import os
 import enum
@@ -20,9 +19,14 @@ NUMBER_COLOR = "#B08000"
 HIGHLIGHT_COLOR = "#FBFA96"
 ERROR_COLOR = "#BF0303"
 WARNING_COLOR = "#CA9219"
+UNREACHABLE_COLOR = "#B4B3B2"
 
 HOVER_TIME = 500
 
+TOKEN_STYLES = ("text", "comment", "mnemonic", "label", "labelref", "number")
+# Tags of tokens are this followed by the token's id
+TOKEN_TAG = "token_"
+
 BREAKPOINT_BG_COLOR = "#FDD"
 
 BREAKPOINT_SHORTENED = {
@@ -43,14 +47,6 @@ class LineBarMode(enum.Enum):
     lineno = "line number"
 
 
-# itertools recipes
-def grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
-
-
 def mouse_inside(widget):
     return (0 <= (widget.winfo_pointerx() - widget.winfo_rootx()) < widget.winfo_width()
             and 0 <= (widget.winfo_pointery() - widget.winfo_rooty()) < widget.winfo_height())
@@ -64,8 +60,8 @@ class ProblemsDialog(simpledialog.Dialog):
     def body(self, master):
         master.pack = lambda *a, p=master.pack, **k: p(*a, fill="both",
                                                        expand=1, **k)
-        self.title("Problems")
         self.assembler.assemble()
+        self.title("Problems ({})".format(self.assembler.problem_index.summary()))
         columns = ["Type", "Problem", "Line", "Text"]
 
         self.treeframe = tkinter.Frame(master)
@@ -82,24 +78,23 @@ class ProblemsDialog(simpledialog.Dialog):
         self.tree.tag_configure("warning", foreground=WARNING_COLOR,
                                 font=normal_font)
 
-        widths = {col: [] for col in columns}
         self.item_to_token = {}
 
+        # The font is fixed width, so only the longest value in each column needs measuring
+        longest = {col: "" for col in columns}
         for col in columns:
             self.tree.heading(col, text=col)
-            widths[col].append(tkfont.Font().measure(col))
-        for token in self.assembler.tokens:
-            for problem in token.problems:
-                item = self.tree.insert("", tkinter.END)
-                values = (problem.name, problem.msg, problem.position.lineno,
-                          problem.position.get_line(self.assembler.code))
-                self.item_to_token[item] = token
-                self.tree.item(item, values=values, tags=problem.cat)
-                for col, v in zip(columns, values):
-                    widths[col].append(bold_font.measure(v) + 15)
-
-        for col, width in widths.items():
-            self.tree.column(col, minwidth=max(width))
+        for token, problem in self.assembler.problem_index.select():
+            values = (problem.name, problem.msg, problem.position.lineno,
+                      problem.position.get_line(self.assembler.code))
+            item = self.tree.insert("", tkinter.END, values=values, tags=problem.cat)
+            self.item_to_token[item] = token
+            for col, v in zip(columns, values):
+                if len(str(v)) > len(longest[col]):
+                    longest[col] = str(v)
+
+        for col, value in longest.items():
+            self.tree.column(col, minwidth=max(tkfont.Font().measure(col), bold_font.measure(value) + 15))
 
         self.tree.bind("<Double-Button-1>", self.double_click)
         self.tree.grid(row=0, column=0, sticky=tkinter.NE + tkinter.SW)
@@ -402,6 +397,7 @@ class CodeEditor(tkinter.Frame):
                                 background="white")
         self.text.tag_configure("number", foreground=NUMBER_COLOR,
                                 background="white")
+        self.text.tag_configure("unreachable", foreground=UNREACHABLE_COLOR)
         self.text.tag_configure("breakpoint", background=BREAKPOINT_BG_COLOR)
 
         self.breakbar.tag_configure("breakpoint", foreground="red", font=bold_font)
@@ -423,6 +419,11 @@ class CodeEditor(tkinter.Frame):
         self.tags = collections.defaultdict(list)
         self.token_to_tag = {}
         self.token_to_problem_tag = {}
+        # What each token was tagged with, (has problems, in error), so that only changed tokens are retagged.
+        # Tags move with the text, so tokens on lines that only moved keep theirs.
+        self.tagged_tokens = {}
+        # Marks on lines edited since they were tagged, whose tags may have been lost even if their code is the same
+        self.edited_marks = []
 
         self.change_breakpoint_var = tkinter.StringVar()
 
@@ -461,6 +462,7 @@ class CodeEditor(tkinter.Frame):
         self.text.edit_reset()
         self.text.edit_modified(False)
         self.set_name()
+        self.forget_syntax()
         self.update_syntax()
         self.update_sidebars()
         self.text.yview_moveto(0.0)
@@ -528,7 +530,7 @@ class CodeEditor(tkinter.Frame):
     # Syntax highlighting
 
     def create_tag(self, token):
-        name = "token_at_" + str(token.position)
+        name = TOKEN_TAG + str(token.id)
         self.tags[name].clear()
         self.text.tag_configure(name, background=HIGHLIGHT_COLOR,
                                 foreground="black")
@@ -539,38 +541,90 @@ class CodeEditor(tkinter.Frame):
 
     def create_problem_tag(self, token):
         if token.problems:
-            pname = "problems_at_" + str(token.position)
+            pname = "problems_" + str(token.id)
             self.token_to_problem_tag[token] = pname
             self.text.tag_configure(pname, font=self.underline_font,
                                     foreground=ERROR_COLOR if token.in_error else WARNING_COLOR)
             self.text.tag_raise(pname)
             return pname
 
-    def update_syntax(self):
-        self.dehighlight()
-        for tag in self.token_to_tag.values():
+    def untag(self, token):
+        tag = self.token_to_tag.pop(token, None)
+        if tag is not None:
             self.text.tag_delete(tag)
-        for tag in self.token_to_problem_tag.values():
+            self.tags.pop(tag, None)
+        tag = self.token_to_problem_tag.pop(token, None)
+        if tag is not None:
             self.text.tag_delete(tag)
-        for tag in self.text.tag_names():
-            self.text.tag_remove(tag, "1.0", tkinter.END)
+
+    def mark_edited(self, args):
+        """Mark the lines touched by an insert, delete or replace of the text"""
+        spread = sum(arg.count("\n") for arg in args[2:] if isinstance(arg, str))
+        lines = set()
+        for index in (args[1], "insert"):
+            try:
+                line = int(self.text.index(index).split(".")[0])
+            except tkinter.TclError:
+                # Indices like sel.first are gone after a delete
+                continue
+            lines.update(range(max(1, line - spread), line + spread + 1))
+        for lineno in lines:
+            mark = "edited_{}".format(len(self.edited_marks))
+            self.text.mark_set(mark, "{}.0".format(lineno))
+            self.edited_marks.append(mark)
+
+    def forget_syntax(self):
+        """Forget all the tagging, after the whole text has been replaced"""
+        for token in self.tagged_tokens:
+            self.untag(token)
+        self.tagged_tokens = {}
+
+    def update_syntax(self):
+        self.dehighlight()
+        edited = set()
+        for mark in self.edited_marks:
+            edited.add(int(self.text.index(mark).split(".")[0]) - 1)
+            self.text.mark_unset(mark)
+        self.edited_marks.clear()
         code = self.text.get("1.0", "end")[:-1]
+        parsed_code = []
         if code:
             self.assembler.update_code(code)
             self.assembler.assemble()
-            self.tags.clear()
-            self.token_to_tag.clear()
-            for line in self.assembler.parsed_code:
-                for token in line:
-                    start = "{}.{}".format(token.position.lineno + 1,
-                                           token.position.start_index)
-                    end = "{}.{}".format(token.position.lineno + 1,
-                                         token.position.end_index)
-                    self.text.tag_add(token.style, start, end)
-                    self.text.tag_add(self.create_tag(token), start, end)
-                    p = self.create_problem_tag(token)
-                    if p:
-                        self.text.tag_add(p, start, end)
+            parsed_code = self.assembler.parsed_code
+        tagged = {}
+        changed = set(edited)
+        for lineno, line in enumerate(parsed_code):
+            for token in line:
+                state = tagged[token] = (bool(token.problems), token.in_error)
+                if self.tagged_tokens.pop(token, None) != state:
+                    changed.add(lineno)
+        # Whatever is left is no longer in the code
+        for token in self.tagged_tokens:
+            self.untag(token)
+        self.tagged_tokens = tagged
+        for lineno in sorted(changed):
+            if lineno >= len(parsed_code):
+                continue
+            line_start, line_end = "{}.0".format(lineno + 1), "{}.0".format(lineno + 2)
+            for style in TOKEN_STYLES:
+                self.text.tag_remove(style, line_start, line_end)
+            for token in parsed_code[lineno]:
+                self.untag(token)
+                start = "{}.{}".format(token.position.lineno + 1,
+                                       token.position.start_index)
+                end = "{}.{}".format(token.position.lineno + 1,
+                                     token.position.end_index)
+                self.text.tag_add(token.style, start, end)
+                self.text.tag_add(self.create_tag(token), start, end)
+                p = self.create_problem_tag(token)
+                if p:
+                    self.text.tag_add(p, start, end)
+        self.text.tag_remove("unreachable", "1.0", tkinter.END)
+        if parsed_code:
+            for address in self.assembler.analysis.unreachable:
+                lineno = self.assembler.instructions[address].position.lineno + 1
+                self.text.tag_add("unreachable", "{}.0".format(lineno), "{}.0".format(lineno + 1))
         self.highlight()
         self.update_sidebars()
 
@@ -687,31 +741,21 @@ class CodeEditor(tkinter.Frame):
 
     # Highlighting and tooltip utils
 
-    def get_tags_at_index(self, index, tags=None):
-        tags = self.text.tag_names() if tags is None else tags
-        ret = []
-        for tag in tags:
-            for start, end in grouper(self.text.tag_ranges(tag), 2):
-                if self.text.compare(start, "<=", index) and self.text.compare(index, "<", end):
-                    ret.append(tag)
-        return ret
-
     def get_hovered_token(self):
         if self.hovered_token_mode == "cursor":
             if not mouse_inside(self):
                 logger.debug("Pointer outside widget")
                 return
             logger.debug("Pointer not outside widget")
-            tag = self.get_tags_at_index("current", self.token_to_tag.values())
+            index = "current"
         else:
-            tag = self.get_tags_at_index("insert", self.token_to_tag.values())
-        if len(tag) > 1:
+            index = "insert"
+        tags = [tag for tag in self.text.tag_names(index) if tag.startswith(TOKEN_TAG)]
+        if len(tags) > 1:
             raise RuntimeError("Hovering over more than one tag")
-        if not tag:
+        if not tags:
             return
-        tag = tag[0]
-        pos = assembler.Position.from_string(tag.replace("token_at_", ""))
-        return self.assembler.get_token_at(pos)
+        return self.assembler.get_token_by_id(int(tags[0][len(TOKEN_TAG):]))
 
     # Highlighting functions
 
@@ -815,6 +859,7 @@ class CodeEditor(tkinter.Frame):
         self.nuke_tooltip()
         self.start_highlight_timer(force=True)
         if stuff[1] != "mark":
+            self.mark_edited(stuff[1:])
             self.start_syntax_update_timer()
             self.update_sidebars()
         self.set_name()
@@ -4,6 +4,7 @@ import logging
 
 import codeeditor
 import assembler
+import objectcache
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +28,7 @@ class AssembleDialog(codeeditor.ProblemsDialog):
         else:
             tkinter.Label(self, text="Assembly failed!").pack()
 
-        tkinter.Label(self, text="Problems:").pack()
+        tkinter.Label(self, text="Problems ({}):".format(self.assembler.problem_index.summary())).pack()
 
         super().body(master)
         self.title("Assembling")
@@ -54,6 +55,8 @@ class CodeMode(tkinter.Frame):
     def __init__(self, master):
         super().__init__(master, bg="blue")
         self.codeeditors = []
+        self.objects = objectcache.ObjectCache()
+        self.objects.trim()
 
         self.menus = []
         self.file_menu = tkinter.Menu(self.master.menu, tearoff=False)
@@ -133,6 +136,8 @@ class CodeMode(tkinter.Frame):
                 self.codeeditors.append(ce)
                 self.tabber.add(ce, sticky=tkinter.NE + tkinter.SW)
                 ce.open(fname)
+                # The editor needs every token to highlight the code, but the CLI can use what it made
+                self.objects.store(ce.assembler)
                 ce.focus_set()
                 ce.set_name()
                 self.tabber.select(ce)
@@ -0,0 +1,109 @@
+"""
+Compiles straight-line runs of LMC machine code into Python functions, so the
+compiled engine of runner.Runner can execute a whole basic block per call.
+"""
+
+
+class Block:
+    def __init__(self, start, code, source, function):
+        self.start = start
+        self.end = start + len(code)
+        self.length = len(code)
+        self.code = code
+        self.last = code[-1]
+        self.source = source
+        self.function = function
+
+    def valid(self, cells):
+        # If any instruction has been overwritten since compilation the block is stale
+        return cells[self.start:self.end] == self.code
+
+    def __repr__(self):
+        return "<{} {:03}-{:03}>".format(self.__class__.__name__, self.start, self.end - 1)
+
+
+def compile_block(cells, start, leaders=()):
+    """
+    Compile the block starting at start. The returned Block's function takes
+    (cells, accumulator, give_output, budget) and returns (accumulator,
+    accumulator before the last instruction, next counter, steps executed).
+    Blocks that branch back to their own start loop internally for as long as
+    the budget of steps allows. Returns None if the first instruction can't be
+    compiled (HLT, INP or an invalid instruction), which should be left to the
+    interpreter.
+    """
+    end = start
+    while end < len(cells) and (end == start or end not in leaders):
+        op, addr = divmod(cells[end], 100)
+        if op in (1, 2, 3, 5) or cells[end] == 902:
+            end += 1
+        elif op in (6, 7, 8):
+            end += 1
+            break
+        else:
+            break
+
+    # A STA into a later instruction of the block would make the rest of it stale, so stop after it
+    for address in range(start, end):
+        op, addr = divmod(cells[address], 100)
+        if op == 3 and address < addr < end:
+            end = address + 1
+            break
+
+    if end == start:
+        return None
+
+    code = cells[start:end]
+    length = len(code)
+    op, target = divmod(code[-1], 100)
+    branches = op in (6, 7, 8)
+    # Only loop inside the function if the block can't overwrite itself
+    loops = branches and target == start and not any(i // 100 == 3 and start <= i % 100 < end for i in code)
+
+    body = []
+    for instruction in code[:-1] if branches else code:
+        op, addr = divmod(instruction, 100)
+        if op == 1:  # ADD
+            body.append("acc = (acc + cells[{}]) % 1000".format(addr))
+        elif op == 2:  # SUB
+            body.append("acc = (acc - cells[{}]) % 1000".format(addr))
+        elif op == 3:  # STA
+            body.append("cells[{}] = acc".format(addr))
+        elif op == 5:  # LDA
+            body.append("acc = cells[{}]".format(addr))
+        else:  # OUT
+            body.append("give_output(acc - 1000 if acc >= 500 else acc)")
+    if branches:
+        body.append("before = acc")
+    else:
+        body.insert(-1, "before = acc")
+
+    op = code[-1] // 100
+    lines = ["def block_{:03}(cells, acc, give_output, budget):".format(start)]
+    if loops:
+        lines.append("    steps = 0")
+        lines.append("    while steps + {} <= budget:".format(length))
+        lines.append("        steps += {}".format(length))
+        lines.extend("        " + line for line in body)
+        if op == 7:  # BRZ
+            lines.append("        if acc != 0:")
+            lines.append("            return acc, before, {}, steps".format(end))
+        elif op == 8:  # BRP
+            lines.append("        if acc >= 500:")
+            lines.append("            return acc, before, {}, steps".format(end))
+        lines.append("    return acc, before, {}, steps".format(start))
+    else:
+        lines.extend("    " + line for line in body)
+        if op == 6:  # BRA
+            lines.append("    return acc, before, {}, {}".format(target, length))
+        elif op == 7:  # BRZ
+            lines.append("    return acc, before, {} if acc == 0 else {}, {}".format(target, end, length))
+        elif op == 8:  # BRP
+            lines.append("    return acc, before, {} if acc < 500 else {}, {}".format(target, end, length))
+        else:
+            lines.append("    return acc, before, {}, {}".format(end, length))
+
+    source = "\n".join(lines) + "\n"
+    namespace = {}
+    exec(compile(source, "<block {:03}>".format(start), "exec"), namespace)
+    return Block(start, code, source, namespace["block_{:03}".format(start)])
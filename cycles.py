@@ -0,0 +1,79 @@
+"""
+Infinite loop detection for Runner. Between inputs a program is a pure
+function of its state, so if the state (counter, accumulator and memory) is
+ever the same twice it will go round the same way for ever. States are only
+looked at when a branch is taken backwards, and compared against one saved
+state that is moved on at every power of two back-edges (Brent's algorithm),
+which finds any cycle without having to remember every state. Memory is
+hashed incrementally, so that comparing states is cheap.
+"""
+import collections
+import random
+
+# length is in steps, since is the steps at which the repeated state was seen first
+Cycle = collections.namedtuple("Cycle", ["length", "since", "addresses"])
+
+HASH_MASK = (1 << 64) - 1
+
+
+def describe_cycle(cycle):
+    return "Stuck in a loop of {} steps since step {}, through addresses {}".format(
+        cycle.length, cycle.since, ", ".join("{:03}".format(address) for address in cycle.addresses))
+
+
+def replay(cells, acc, counter, steps):
+    """The addresses executed in running steps instructions from a state that doesn't reach HLT or INP"""
+    cells = list(cells)
+    executed = set()
+    for _ in range(steps):
+        pc = counter
+        executed.add(pc)
+        op, addr = divmod(cells[pc], 100)
+        counter = pc + 1
+        if op == 1:  # ADD
+            acc = (acc + cells[addr]) % 1000
+        elif op == 2:  # SUB
+            acc = (acc - cells[addr]) % 1000
+        elif op == 3:  # STA
+            cells[addr] = acc
+        elif op == 5:  # LDA
+            acc = cells[addr]
+        elif op == 6 or (op == 7 and acc == 0) or (op == 8 and acc < 500):  # BRA, BRZ, BRP
+            counter = addr
+    return sorted(executed)
+
+
+class CycleDetector:
+    def __init__(self, size=100):
+        self.keys = [random.getrandbits(64) for _ in range(size)]
+        self.hash = 0
+        self.saved = None
+
+    def reset(self, cells, steps=0):
+        """Start again from the current state, after the memory has been changed from outside"""
+        self.hash = sum(value * key for value, key in zip(cells, self.keys)) & HASH_MASK
+        self.saved = None
+        self.saved_steps = steps
+        # Back-edges since the state was saved, and how many to go before moving it on
+        self.edges = 0
+        self.limit = 1
+
+    def store(self, address, old, new):
+        """Update the hash for a STA of new over old at address"""
+        self.hash = (self.hash + (new - old) * self.keys[address]) & HASH_MASK
+
+    def back_edge(self, cells, acc, counter, steps):
+        """Look at the state after a branch taken backwards, returning a Cycle if it has been seen before"""
+        state = (counter, acc, self.hash)
+        if self.saved is not None and state == self.saved[0] and tuple(cells) == self.saved[1]:
+            length = steps - self.saved_steps
+            cycle = Cycle(length, self.saved_steps, replay(cells, acc, counter, length))
+            self.reset(cells, steps)
+            return cycle
+        self.edges += 1
+        if self.saved is None or self.edges == self.limit:
+            self.saved = (state, tuple(cells))
+            self.saved_steps = steps
+            self.edges = 0
+            self.limit *= 2
+        return None
@@ -1,5 +1,6 @@
 import tkinter
 from tkinter import font as tkfont
+import functools
 import logging
 
 import codeeditor
@@ -11,6 +12,7 @@ READ_COLOR = "#EE0"
 WRITTEN_COLOR = "#E00"
 EXECUTED_COLOR = "#0A0"
 NEXT_EXEC_COLOR = "#CCC"
+PROFILE_COLOR = "#00A"
 
 
 COLOR_MAP = dict(zip(runner.ValueState, ["#FFF", READ_COLOR, WRITTEN_COLOR,
@@ -56,6 +58,11 @@ class DebugCodeEditor(codeeditor.CodeEditor):
         self.text.tag_lower("state_" + runner.ValueState.normal.value)
         self.text["state"] = "disabled"
 
+        # Execution counts, shown while the runner is profiling
+        self.profilebar = tkinter.Text(self.sideframe, bg="white", fg=PROFILE_COLOR, width=1, wrap=tkinter.NONE)
+        self.profilebar["yscrollcommand"] = functools.partial(self.yscroll, self.profilebar, yxmode=True)
+        self.profilebar["state"] = "disabled"
+
     def update_runner(self, runner):
         self.runner = runner
         self.assembler = self.runner.assembler
@@ -66,23 +73,63 @@ class DebugCodeEditor(codeeditor.CodeEditor):
         self.text.edit_modified(False)
         self.text["state"] = "disabled"
         self.set_name()
+        self.forget_syntax()
         self.update_syntax()
 
-    def update_syntax(self):
+    def update_syntax(self, addresses=None):
+        """
+        Repaint the value states of the given addresses. If addresses is None
+        the syntax highlighting is redone and every address is repainted.
+        """
         self.text["state"] = "normal"
-        super().update_syntax()
-        for state in runner.ValueState:
-            self.text.tag_remove("state_" + state.value, "1.0", tkinter.END)
+        if addresses is None:
+            super().update_syntax()
+            for state in runner.ValueState:
+                self.text.tag_remove("state_" + state.value, "1.0", tkinter.END)
         if self.runner:
-            for val in self.runner.memory:
+            for address in range(len(self.runner.memory)) if addresses is None else addresses:
+                val = self.runner.memory[address]
                 if val.token is None:
                     continue
                 lineno = val.token.position.lineno + 1
-                self.text.tag_add("state_" + val.state.value,
-                                  str(lineno) + ".0",
-                                  str(lineno + 1) + ".0")
+                start, end = str(lineno) + ".0", str(lineno + 1) + ".0"
+                if addresses is not None:
+                    for state in runner.ValueState:
+                        self.text.tag_remove("state_" + state.value, start, end)
+                self.text.tag_add("state_" + val.state.value, start, end)
         self.text["state"] = "disabled"
 
+    def yscroll(self, w, *a, yxmode=False):
+        super().yscroll(w, *a, yxmode=yxmode)
+        if w != self.profilebar:
+            if yxmode:
+                self.profilebar.yview_moveto(a[0])
+            else:
+                self.profilebar.yview(*a)
+
+    def show_profile(self, value):
+        if value:
+            self.profilebar.grid(column=2, row=0, sticky=tkinter.N + tkinter.S)
+            self.update_profile()
+        else:
+            self.profilebar.grid_forget()
+
+    def update_profile(self):
+        """Show how many times each line has been executed"""
+        if self.runner is None or self.runner.profile is None:
+            return
+        executed = self.runner.profile.executed
+        counts = [""] * (int(self.text.index("end").split(".")[0]) - 1)
+        for instr in self.assembler.instructions:
+            if executed[instr.address] and instr.position.lineno < len(counts):
+                counts[instr.position.lineno] = str(executed[instr.address])
+        self.profilebar["state"] = "normal"
+        self.profilebar.delete("1.0", tkinter.END)
+        self.profilebar.insert(tkinter.END, "\n".join(counts))
+        self.profilebar["width"] = max(map(len, counts), default=1) or 1
+        self.profilebar["state"] = "disabled"
+        self.profilebar.yview_moveto(self.text.yview()[0])
+
     def make_tooltip(self, token):
         if self.tooltip:
             self.nuke_tooltip()
@@ -0,0 +1,173 @@
+"""
+Headless test harness: runs a program over a list of test cases, each with
+the inputs to give, the outputs expected and a step limit, spread over a pool
+of worker processes.
+"""
+import concurrent.futures
+import json
+import os
+import time
+
+import objectcache
+import resultcache
+import runner
+
+# The runner of the current worker process, set up by init_worker
+_runner = None
+
+# The parts of a result that depend only on the program and the case's inputs and step limit
+RECORD_KEYS = ("halt_reason", "steps", "outputs", "error", "cycle")
+
+
+def init_worker(code, engine=runner.Engine.normal, detect_loops=False, objects=None):
+    """
+    Assemble the program once, or find it in the object cache directory
+    objects, the runner is reset for each case.
+    """
+    global _runner
+    assem = objectcache.assemble(code, None if objects is None else objectcache.ObjectCache(objects))
+    _runner = runner.Runner(None, engine=engine)
+    _runner.load_code(assem)
+    if assem.in_error:
+        raise RuntimeError("Assembly failed")
+    _runner.enable_cycle_detection(detect_loops)
+
+
+def run_case(case, max_steps=None, timeout=None):
+    """
+    Run a single case on the worker's runner. case is a dict with "inputs",
+    and optionally "expected", "max_steps" and "name". Returns a result dict.
+    """
+    start = time.perf_counter()
+    _runner.reset()
+    record = execute(_runner, case.get("inputs", []), case.get("max_steps", max_steps), timeout)
+    return case_result(case, record, time.perf_counter() - start)
+
+
+def execute(run, inputs, max_steps=None, timeout=None, output=None, keep_outputs=True):
+    """
+    Run a runner on from where it is, taking inputs, and return the record of
+    how it went (see RECORD_KEYS). output, if given, is called with each
+    value as it is output. Without keep_outputs the record's outputs are left
+    empty, so a program that never stops doesn't fill up memory.
+    """
+    outputs = []
+
+    def give_output(value):
+        if isinstance(value, int):
+            if keep_outputs:
+                outputs.append(value)
+            if output is not None:
+                output(value)
+
+    run.give_output = give_output
+    run.set_inputs(inputs)
+    run.pull_input()
+    record = {}
+    try:
+        reason = run.halt_reason
+        # Halted, or left waiting for an input that isn't there, it can't go any further
+        if reason not in (runner.HaltReason.hlt, runner.HaltReason.input):
+            # Run a chunk at a time, as Runner.run keeps the values output until it returns
+            deadline = None if timeout is None else time.perf_counter() + timeout
+            steps = 0
+            while True:
+                chunk = runner.RUN_CHUNK if max_steps is None else min(runner.RUN_CHUNK, max_steps - steps)
+                summary = run.run(max_steps=chunk, timeout=deadline and deadline - time.perf_counter())
+                steps += summary.steps
+                reason = summary.halt_reason
+                if reason is not runner.HaltReason.step_limit or steps == max_steps:
+                    break
+        record["halt_reason"] = reason.value
+    except RuntimeError as e:
+        record["halt_reason"] = None
+        record["error"] = e.args[0]
+    except IndexError:
+        record["halt_reason"] = None
+        record["error"] = "Ran off the end of memory"
+    record["steps"] = run.steps
+    record["outputs"] = outputs
+    if record["halt_reason"] == runner.HaltReason.cycle.value:
+        record["cycle"] = run.cycle._asdict()
+    return record
+
+
+def case_result(case, record, elapsed):
+    """The result dict for a case, from the record of running it (see resultcache.ResultCache)"""
+    expected = case.get("expected")
+    result = {"passed": (record["halt_reason"] == runner.HaltReason.hlt.value
+                         and (expected is None or record["outputs"] == expected)),
+              "halt_reason": record["halt_reason"],
+              "steps": record["steps"],
+              "time": elapsed,
+              "outputs": record["outputs"]}
+    if expected is not None:
+        result["expected"] = expected
+    for key in ("error", "cycle"):
+        if key in record:
+            result[key] = record[key]
+    if "name" in case:
+        result["name"] = case["name"]
+    return result
+
+
+def _run_cases(code, cases, engine, max_steps, timeout, jobs, detect_loops, objects):
+    if jobs == 1:
+        init_worker(code, engine, detect_loops, objects)
+        for case in cases:
+            yield run_case(case, max_steps, timeout)
+        return
+    if not cases:
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                initargs=(code, engine, detect_loops, objects)) as executor:
+        chunksize = max(1, len(cases) // (4 * (jobs or os.cpu_count() or 1)))
+        yield from executor.map(run_case, cases, [max_steps] * len(cases), [timeout] * len(cases),
+                                chunksize=chunksize)
+
+
+def run_batch(code, cases, engine=runner.Engine.normal, max_steps=None, timeout=None, jobs=None,
+              detect_loops=False, cache=None, objects=None):
+    """
+    Run every case over jobs worker processes (one per CPU by default, or in
+    this process if jobs is 1), yielding the results in the order of cases.
+    max_steps is the default step limit for cases without one. With
+    detect_loops, cases stuck in an infinite loop stop as soon as it is found.
+    Results found in cache (a resultcache.ResultCache) aren't run again, and
+    are marked "cached". The program is assembled through objects (an
+    objectcache.ObjectCache) if given, by the workers too.
+    """
+    engine = runner.Engine(engine)
+    cases = list(cases)
+    directory = None if objects is None else objects.directory
+    if cache is not None:
+        assem = objectcache.assemble(code, objects)
+    if cache is None or assem.in_error:
+        for index, result in enumerate(_run_cases(code, cases, engine, max_steps, timeout, jobs, detect_loops,
+                                                  directory)):
+            yield dict(result, index=index)
+        return
+
+    keys = [resultcache.result_key(assem.machine_code, case.get("inputs", []), case.get("max_steps", max_steps),
+                                   detect_loops) for case in cases]
+    records = [cache.get(key) for key in keys]
+    missing = [case for case, record in zip(cases, records) if record is None]
+    results = _run_cases(code, missing, engine, max_steps, timeout, jobs, detect_loops, directory)
+    for index, (case, key, record) in enumerate(zip(cases, keys, records)):
+        if record is None:
+            result = next(results)
+            # How far a program gets before a timeout depends on the machine, so it can't be reused
+            if result["halt_reason"] != runner.HaltReason.timeout.value:
+                cache.put(key, {name: value for name, value in result.items() if name in RECORD_KEYS})
+            yield dict(result, index=index)
+        else:
+            yield dict(case_result(case, record, 0.0), index=index, cached=True)
+
+
+def load_cases(fname):
+    """Load a list of cases from a JSON file, either a list or an object with a "cases" list"""
+    with open(fname) as f:
+        cases = json.load(f)
+    if isinstance(cases, dict):
+        cases = cases["cases"]
+    return cases
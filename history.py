@@ -0,0 +1,77 @@
+"""
+Undo log for Runner.step_back. Each instruction executed is recorded as one
+packed 32 bit entry in a ring buffer: the address it was executed from, where
+it could have written to (the accumulator, or a memory address for STA) and
+the value that held before. Snapshots taken every so often mean going a long
+way back only needs the entries after the nearest snapshot to be undone.
+"""
+import array
+import collections
+
+# Bits of an entry used by the address executed and by where it wrote (0 for the accumulator, or address + 1)
+ADDRESS_BITS = 10
+WHERE_BITS = 7
+
+Entry = collections.namedtuple("Entry", ["pc", "address", "old"])
+
+
+class History:
+    def __init__(self, steps=0, capacity=1000000, snapshot_interval=10000):
+        self.capacity = capacity
+        self.snapshot_interval = snapshot_interval
+        self.log = array.array("I", bytes(4 * capacity))
+        self.clear(steps)
+
+    def clear(self, steps=0):
+        # The log covers the steps from end - length to end
+        self.end = steps
+        self.length = 0
+        self.snapshots = collections.deque()
+
+    def __len__(self):
+        return self.length
+
+    def record(self, pc, address, old):
+        """Record an instruction at pc that wrote to address (None for the accumulator), which held old"""
+        where = 0 if address is None else address + 1
+        self.log[self.end % self.capacity] = pc | where << ADDRESS_BITS | old << (ADDRESS_BITS + WHERE_BITS)
+        self.end += 1
+        if self.length < self.capacity:
+            self.length += 1
+
+    def peek(self):
+        """The newest Entry, or None"""
+        if not self.length:
+            return None
+        entry = self.log[(self.end - 1) % self.capacity]
+        where = entry >> ADDRESS_BITS & (1 << WHERE_BITS) - 1
+        return Entry(entry & (1 << ADDRESS_BITS) - 1, where - 1 if where else None,
+                     entry >> (ADDRESS_BITS + WHERE_BITS))
+
+    def pop(self):
+        """Remove and return the newest Entry"""
+        entry = self.peek()
+        self.end -= 1
+        self.length -= 1
+        return entry
+
+    def add_snapshot(self, snapshot):
+        self.snapshots.append(snapshot)
+        # Snapshots from before the start of the log can't be got back to
+        while self.snapshots[0].steps < self.end - self.length:
+            self.snapshots.popleft()
+
+    def nearest_snapshot(self, steps):
+        """The earliest snapshot taken at or after steps, or None"""
+        for snapshot in self.snapshots:
+            if snapshot.steps >= steps:
+                return snapshot
+        return None
+
+    def truncate(self, steps):
+        """Forget everything after steps"""
+        if steps < self.end:
+            self.length -= self.end - steps
+            self.end = steps
+        while self.snapshots and self.snapshots[-1].steps > steps:
+            self.snapshots.pop()
@@ -0,0 +1,149 @@
+"""
+Runs one program over many sets of inputs at once. Each run is a lane: the
+memory of every lane is a row of an (N, 100) array, and every tick executes
+one instruction on every live lane, with masks for the different opcodes and
+branch outcomes. Lanes retire individually when they halt, run out of input,
+hit an invalid instruction or use up their steps.
+"""
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from runner import HaltReason, int_to_complement
+
+LaneResult = collections.namedtuple("LaneResult", ["steps", "halt_reason", "outputs", "error"])
+
+
+class LockstepRunner:
+    def __init__(self, machine_code, inputs):
+        """
+        machine_code is the program (as in Assembler.machine_code) and inputs a
+        sequence with one sequence of input values per lane.
+        """
+        if numpy is None:
+            raise RuntimeError("The lockstep runner needs numpy")
+        if len(machine_code) > 100:
+            raise RuntimeError("Program is too large ({} cells)".format(len(machine_code)))
+        inputs = [[int_to_complement(i) for i in lane] for lane in inputs]
+        lanes = len(inputs)
+        # Memory past the program is zeroed, as in Runner
+        self.memory = numpy.zeros((lanes, 100), dtype=numpy.int16)
+        self.memory[:, :len(machine_code)] = machine_code
+        self.accumulator = numpy.zeros(lanes, dtype=numpy.int16)
+        self.counter = numpy.zeros(lanes, dtype=numpy.int16)
+        self.steps = numpy.zeros(lanes, dtype=numpy.int64)
+        # Input queues, padded out to the longest
+        self.inputs = numpy.zeros((lanes, max(map(len, inputs), default=0) + 1), dtype=numpy.int16)
+        for lane, values in enumerate(inputs):
+            self.inputs[lane, :len(values)] = values
+        self.input_count = numpy.array([len(values) for values in inputs], dtype=numpy.int64)
+        self.input_pos = numpy.zeros(lanes, dtype=numpy.int64)
+        self.live = numpy.arange(lanes)
+        self.ticks = 0
+        self.halt_reasons = [None] * lanes
+        self.errors = [None] * lanes
+        # (lanes, values) of each tick that output anything, split into per-lane lists by outputs()
+        self.output_log = []
+
+    def retire(self, lanes, reason, errors=None, steps=None):
+        errors = [None] * len(lanes) if errors is None else errors
+        for lane, error in zip(lanes.tolist(), errors):
+            self.halt_reasons[lane] = reason
+            self.errors[lane] = error
+        self.steps[lanes] = self.ticks if steps is None else steps
+
+    def tick(self):
+        """Execute one instruction on every live lane. Returns the number of lanes still live."""
+        live = self.live
+        memory = self.memory
+        self.ticks += 1
+        pc = self.counter[live]
+        # Running off the end of memory is an error in Runner as well, operands can't be out of range
+        outside = pc >= 100
+        instruction = memory[live, numpy.where(outside, 0, pc)]
+        op, addr = numpy.divmod(instruction, 100)
+        acc = self.accumulator[live]
+        counter = pc + 1
+        done = numpy.zeros(len(live), dtype=bool)
+
+        if outside.any():
+            # The instruction was never fetched, so it doesn't count as a step
+            self.retire(live[outside], None, ["Ran off the end of memory"] * int(outside.sum()), self.ticks - 1)
+            done |= outside
+        ok = ~done
+
+        invalid = ok & (((op == 0) & (addr != 0)) | (op == 4) | ((op == 9) & (addr != 1) & (addr != 2)))
+        if invalid.any():
+            self.retire(live[invalid], None,
+                        ["Invalid instruction {:03}".format(i) for i in instruction[invalid].tolist()])
+            done |= invalid
+            ok &= ~invalid
+
+        mask = ok & (op == 1)  # ADD
+        acc[mask] = (acc[mask] + memory[live[mask], addr[mask]]) % 1000
+        mask = ok & (op == 2)  # SUB
+        acc[mask] = (acc[mask] - memory[live[mask], addr[mask]]) % 1000
+        mask = ok & (op == 3)  # STA
+        memory[live[mask], addr[mask]] = acc[mask]
+        mask = ok & (op == 5)  # LDA
+        acc[mask] = memory[live[mask], addr[mask]]
+        mask = ok & ((op == 6) | ((op == 7) & (acc == 0)) | ((op == 8) & (acc < 500)))  # BRA, BRZ, BRP
+        counter[mask] = addr[mask]
+
+        mask = ok & (instruction == 902)  # OUT
+        if mask.any():
+            values = acc[mask].astype(numpy.int64)
+            self.output_log.append((live[mask], numpy.where(values >= 500, values - 1000, values)))
+
+        mask = ok & (instruction == 901)  # INP
+        if mask.any():
+            lanes = live[mask]
+            pos = self.input_pos[lanes]
+            have = pos < self.input_count[lanes]
+            acc[mask] = numpy.where(have, self.inputs[lanes, pos], acc[mask])
+            self.input_pos[lanes] += have
+            starved = mask.copy()
+            starved[mask] = ~have
+            self.retire(live[starved], HaltReason.input)
+            done |= starved
+
+        mask = ok & (instruction == 0)  # HLT
+        if mask.any():
+            self.retire(live[mask], HaltReason.hlt)
+            done |= mask
+
+        counter[outside] = pc[outside]
+        self.accumulator[live] = acc
+        self.counter[live] = counter
+        if done.any():
+            self.live = live[~done]
+        return len(self.live)
+
+    def run(self, max_steps=None):
+        """
+        Tick until every lane has retired, or max_steps ticks have been
+        executed. Returns a LaneResult for each lane. Lanes that ran out of
+        input have executed the INP, as Runner does before asking for input.
+        """
+        while len(self.live) and self.ticks != max_steps:
+            self.tick()
+        if len(self.live):
+            self.retire(self.live, HaltReason.step_limit)
+            self.live = self.live[:0]
+        return [LaneResult(steps, reason, outputs, error)
+                for steps, reason, outputs, error in zip(self.steps.tolist(), self.halt_reasons,
+                                                         self.outputs(), self.errors)]
+
+    def outputs(self):
+        """The values output by each lane so far"""
+        outputs = [[] for _ in self.halt_reasons]
+        if self.output_log:
+            lanes = numpy.concatenate([lanes for lanes, values in self.output_log])
+            values = numpy.concatenate([values for lanes, values in self.output_log])
+            order = numpy.argsort(lanes, kind="stable")
+            for lane, value in zip(lanes[order].tolist(), values[order].tolist()):
+                outputs[lane].append(value)
+        return outputs
@@ -0,0 +1,242 @@
+"""
+Cache of assembled programs, kept on disk as a JSON file per program, named
+by the hash of its code, so that unchanged files aren't tokenised and parsed
+again. Keys include the format version and a hash of the assembler's source,
+so entries from other versions are never used. The directory is trimmed to
+a maximum size by throwing away the least recently used files.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import analysis
+import assembler
+import cache
+import problems
+
+logger = logging.getLogger(__name__)
+
+# Part of every key, so changing the layout of the files leaves the old ones unused until they are trimmed
+FORMAT_VERSION = 1
+
+DEFAULT_DIRECTORY = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                 "specter", "objects")
+
+# The modules whose source decides what the assembler makes of some code
+SOURCES = (assembler, analysis, problems)
+
+TOKEN_CLASSES = {cls.__name__: cls for cls in (assembler.Token, assembler.Comment, assembler.Mnemonic,
+                                               assembler.Label, assembler.LabelRef, assembler.Number)}
+PROBLEM_CLASSES = {cls.__name__: cls for cls in (problems.SyntaxError, problems.SemanticError,
+                                                 problems.RuntimeWarning, problems.StyleWarning)}
+
+_assembler_version = None
+
+
+def assembler_version():
+    global _assembler_version
+    if _assembler_version is None:
+        digest = hashlib.sha256()
+        for module in SOURCES:
+            with open(module.__file__, "rb") as f:
+                digest.update(f.read())
+        _assembler_version = digest.hexdigest()
+    return _assembler_version
+
+
+def object_key(code):
+    digest = hashlib.sha256("{} {}\n".format(FORMAT_VERSION, assembler_version()).encode())
+    digest.update(code.encode())
+    return digest.hexdigest()
+
+
+def serialise(assem):
+    """The JSON-able form of an Assembler, which must have been parsed"""
+    tokens = []
+    token_numbers = {}
+
+    def number(token):
+        if token.id not in token_numbers:
+            token_numbers[token.id] = len(tokens)
+            position = token.position
+            tokens.append([token.__class__.__name__, token.text, position.lineno, position.start_index,
+                           position.end_index])
+        return token_numbers[token.id]
+
+    def position(pos):
+        return [pos.lineno, pos.start_index, pos.end_index]
+
+    # Numbered in the order of the problems first, which is the order the ProblemIndex needs them in
+    found = [[number(token), problem.__class__.__name__, problem.msg, position(problem.position),
+              [[msg, number(extra)] for msg, extra in problem.extra]]
+             for token, problem in assem.problem_index.select()]
+    instructions = []
+    for instr in assem.instructions:
+        arg = instr.arg.resolve() if instr.arg is not None else None
+        instructions.append([number(instr), None if arg is None else position(instr.arg.position) + [arg]])
+    return {"in_error": assem.in_error,
+            "machine_code": None if assem.in_error else assem.machine_code[:assem.machine_code_length],
+            "instructions": instructions,
+            "labels": [[number(label), label.address] for _, label in assem.labels.values()],
+            "problems": found,
+            "tokens": tokens}
+
+
+def assemble(code, objects=None):
+    """Assemble code, through the ObjectCache objects if there is one"""
+    if objects is not None:
+        return objects.assemble(code)
+    assem = assembler.Assembler()
+    assem.update_code(code)
+    assem.assemble()
+    return assem
+
+
+class CachedProgram:
+    """
+    A program restored from the cache, with the parts of an Assembler that
+    are needed to run it, profile it and show its problems: code, raw_code,
+    machine_code, machine_code_length, in_error, instructions, labels,
+    problems, problem_index and analysis. Arguments come back as Numbers of
+    what they resolved to.
+    """
+    def __init__(self, code, data):
+        self.code = code.split("\n")
+        tokens = [TOKEN_CLASSES[name](text, assembler.Position(lineno, start, end))
+                  for name, text, lineno, start, end in data["tokens"]]
+        self.instructions = []
+        for number, arg in data["instructions"]:
+            instr = tokens[number]
+            if arg is not None:
+                lineno, start, end, value = arg
+                instr.link_arg(assembler.Number(str(value), assembler.Position(lineno, start, end)))
+            instr.address = len(self.instructions)
+            self.instructions.append(instr)
+        self.labels = {}
+        for number, address in data["labels"]:
+            tokens[number].address = address
+            self.labels[tokens[number].text] = (None, tokens[number])
+        for number, name, msg, (lineno, start, end), extra in data["problems"]:
+            tokens[number].problems.append(PROBLEM_CLASSES[name](msg, assembler.Position(lineno, start, end),
+                                                                 extra=[(text, tokens[extra_number])
+                                                                        for text, extra_number in extra]))
+        self.problem_index = assembler.ProblemIndex(tokens)
+        self.in_error = data["in_error"]
+        self.machine_code = self.machine_code_length = None
+        if not self.in_error:
+            self.machine_code = data["machine_code"]
+            self.machine_code_length = len(self.machine_code)
+            self.machine_code += [0] * (100 - self.machine_code_length)
+        self._analysis = None
+
+    @property
+    def analysis(self):
+        # Only running the program needs it
+        if self._analysis is None:
+            self._analysis = analysis.Analysis(self.instructions)
+        return self._analysis
+
+    @property
+    def raw_code(self):
+        return "\n".join(self.code)
+
+    @property
+    def problems(self):
+        return list(self.problem_index)
+
+    def assemble(self):
+        return self.machine_code
+
+
+class ObjectCache(cache.Cache):
+    """
+    Programs are got with assemble, which gives a CachedProgram if the code
+    was stored, or else an Assembler, which it stores. Files that can't be
+    read or written are treated as missing, so the cache can never stop a
+    program from being assembled.
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=32 << 20):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, code):
+        """The CachedProgram of code, or None"""
+        path = self.path(object_key(code))
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            # Mark it as used, for trimming
+            os.utime(path)
+            program = CachedProgram(code, data)
+        except FileNotFoundError:
+            program = None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring broken cache entry {}: {!r}", path, e)
+            program = None
+        return self.counted(program)
+
+    def store(self, assem):
+        """Store an Assembler under its code, if it isn't already"""
+        path = self.path(object_key(assem.raw_code))
+        if os.path.exists(path):
+            return
+        assem.assemble()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written to a temporary file first, so that other processes never see half of it
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(serialise(assem), f, separators=(",", ":"))
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        except OSError as e:
+            logger.warning("Could not write to the cache: {!r}", e)
+
+    def assemble(self, code):
+        """Assemble code, or find it already assembled"""
+        program = self.load(code)
+        if program is None:
+            program = assembler.Assembler()
+            program.update_code(code)
+            self.store(program)
+        return program
+
+    def trim(self):
+        """Throw away the least recently used programs until the directory fits in max_bytes"""
+        try:
+            entries = []
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not evict {}: {!r}", path, e)
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.debug("Evicted {} programs from the cache", evicted)
+
+    def close(self):
+        self.trim()
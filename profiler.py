@@ -0,0 +1,87 @@
+"""
+Execution profiling for Runner: per-address counts of how often each cell was
+executed, read and written, and how often the branch at each address jumped
+backwards, which is what marks out the loops of a program.
+"""
+import array
+import collections
+
+# A loop runs from start to the backwards branch at end
+Loop = collections.namedtuple("Loop", ["start", "end", "iterations", "executed"])
+
+
+def counters(size):
+    return array.array("Q", bytes(8 * size))
+
+
+def line_of(assembler, address):
+    if address < len(assembler.instructions):
+        return assembler.instructions[address].position.lineno + 1
+    return "?"
+
+
+class Profile:
+    def __init__(self, size=100):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.executed = counters(self.size)
+        self.read = counters(self.size)
+        self.written = counters(self.size)
+        self.back_edges = counters(self.size)
+
+    def count(self, pc, instruction, counter):
+        """Count an instruction executed at pc, which left the counter at counter"""
+        self.executed[pc] += 1
+        op, addr = divmod(instruction, 100)
+        if op in (1, 2, 5):  # ADD, SUB, LDA
+            self.read[addr] += 1
+        elif op == 3:  # STA
+            self.written[addr] += 1
+        elif op in (6, 7, 8) and counter == addr <= pc:  # A branch taken backwards
+            self.back_edges[pc] += 1
+
+    @property
+    def total(self):
+        return sum(self.executed)
+
+    def hot_loops(self, cells):
+        """The loops that were entered, hottest (most instructions executed inside) first"""
+        loops = []
+        for end, iterations in enumerate(self.back_edges):
+            if iterations:
+                start = cells[end] % 100
+                loops.append(Loop(start, end, iterations, sum(self.executed[start:end + 1])))
+        loops.sort(key=lambda loop: loop.executed, reverse=True)
+        return loops
+
+    def report(self, assembler, cells=None, loops=10):
+        """
+        Render the counts as a table of the program's instructions, with their
+        source lines and labels, followed by the hottest loops.
+        """
+        cells = assembler.machine_code if cells is None else cells
+        labels = {}
+        for name, (_, label) in sorted(assembler.labels.items()):
+            labels.setdefault(label.address, name)
+        total = self.total or 1
+
+        out = ["Addr  Line  Label       Executed      Read   Written  Source"]
+        for instr in assembler.instructions:
+            address = instr.address
+            out.append("{:03}  {:>4}  {:<10}{:>9} {:>9} {:>9}  {}".format(
+                address, instr.position.lineno + 1, labels.get(address, ""), self.executed[address],
+                self.read[address], self.written[address], instr.position.get_line(assembler.code).strip()))
+        out.append("Total executed: {}".format(self.total))
+
+        hot = self.hot_loops(cells)[:loops]
+        if hot:
+            out.append("")
+            out.append("Hot loops:")
+        for rank, loop in enumerate(hot, 1):
+            out.append("{:>3}. {:03}-{:03} {}(lines {}-{}): {} iterations, {} instructions ({:.1%})".format(
+                rank, loop.start, loop.end, labels[loop.start] + " " if loop.start in labels else "",
+                line_of(assembler, loop.start), line_of(assembler, loop.end), loop.iterations, loop.executed,
+                loop.executed / total))
+        return "\n".join(out)
@@ -0,0 +1,92 @@
+"""
+Cache of the results of running programs, keyed on the machine code, the
+inputs and the step limit, so that an unchanged program isn't run over the
+same inputs twice. The most recently used results are kept in memory, in
+front of an optional sqlite database which is trimmed to a maximum size by
+throwing away the least recently used.
+"""
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+# Bump when what is stored changes, so that old entries are never used
+FORMAT_VERSION = 1
+
+
+def result_key(machine_code, inputs, max_steps=None, detect_loops=False):
+    data = json.dumps([FORMAT_VERSION, list(machine_code), list(inputs), max_steps, detect_loops])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResultCache(cache.Cache):
+    """
+    Results are dicts of "halt_reason", "steps" and "outputs", and "error" or
+    "cycle" where there was one, as made by harness.run_case.
+    """
+    def __init__(self, path=None, capacity=1024, max_bytes=64 << 20):
+        super().__init__()
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.recent = collections.OrderedDict()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results"
+                            " (key TEXT PRIMARY KEY, value TEXT, size INTEGER, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    def _remember(self, key, result):
+        self.recent[key] = result
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+    def get(self, key):
+        """The result stored under key, or None"""
+        result = self.recent.get(key)
+        if result is not None:
+            self.recent.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+                self.db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+                self._remember(key, result)
+        return self.counted(result)
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.db is not None:
+            value = json.dumps(result)
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            (key, value, len(value), time.time()))
+
+    def trim(self):
+        """Throw away the least recently used results until the database fits in max_bytes"""
+        if self.db is None:
+            return
+        total, = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM results WHERE key = ?", doomed)
+        logger.debug("Evicted {} results from the cache", len(doomed))
+
+    def close(self):
+        if self.db is not None:
+            self.trim()
+            self.db.commit()
+            self.db.close()
+            self.db = None
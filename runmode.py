@@ -11,6 +11,10 @@ import dbgcodeeditor
 
 STICKY_NESW = tkinter.NE + tkinter.SW
 
+# When running at full speed, execute up to this many instructions (or seconds) between refreshes
+RUN_CHUNK_STEPS = 10000
+RUN_CHUNK_TIME = 0.05
+
 logger = logging.getLogger(__name__)
 
 
@@ -70,12 +74,17 @@ class MemoryDisplay(tkinter.Frame):
             self.after(0, self.updater)
         return True
 
-    def update_memory(self, runner):
-        for i, m in enumerate(runner.memory):
-            self.mem_vars[i].set(str(m.value).zfill(3))
-
-    def set_colors(self, runner_):
-        for i, m in enumerate(runner_.memory):
+    def update_memory(self, runner, addresses=None):
+        if addresses is None:
+            addresses = range(len(runner.cells))
+        for i in addresses:
+            self.mem_vars[i].set(str(runner.cells[i]).zfill(3))
+
+    def set_colors(self, runner_, addresses=None):
+        if addresses is None:
+            addresses = range(len(runner_.memory))
+        for i in addresses:
+            m = runner_.memory[i]
             self.memory_nums[i]["readonlybackground"] = dbgcodeeditor.darken(dbgcodeeditor.COLOR_MAP[m.state])
             self.memorys[i]["bg"] = dbgcodeeditor.COLOR_MAP[m.state]
             if (runner_.breakpoints_active
@@ -113,24 +122,30 @@ class RunMode(tkinter.Frame):
         self.run_step_btn.grid(row=0, column=1, sticky=tkinter.E + tkinter.W,
                                padx=2, pady=2)
 
+        self.step_back_btn = tkinter.Button(self.button_frame,
+                                            text="Step back",
+                                            command=self.step_back)
+        self.step_back_btn.grid(row=0, column=2, sticky=tkinter.E + tkinter.W,
+                                padx=2, pady=2)
+
         self.reset_btn = tkinter.Button(self.button_frame, text="Reset",
                                         command=self.reset)
-        self.reset_btn.grid(row=0, column=2, sticky=tkinter.E + tkinter.W,
+        self.reset_btn.grid(row=0, column=3, sticky=tkinter.E + tkinter.W,
                             padx=2, pady=2)
 
         self.debug_var = tkinter.BooleanVar(value=False)
         self.debug_btn = tkinter.Button(self.button_frame,
                                         command=self.toggle_debug, text="Debug")
-        self.debug_btn.grid(row=0, column=3, sticky=tkinter.E + tkinter.W,
+        self.debug_btn.grid(row=0, column=4, sticky=tkinter.E + tkinter.W,
                             padx=2, pady=2)
 
         switch_cmd = getattr(self.master, "codemode", lambda: None)
         self.exit_btn = tkinter.Button(self.button_frame, text="Back to code",
                                        command=switch_cmd)
-        self.exit_btn.grid(row=0, column=4, sticky=tkinter.E + tkinter.W,
+        self.exit_btn.grid(row=0, column=5, sticky=tkinter.E + tkinter.W,
                            padx=2, pady=2)
 
-        for col in range(5):
+        for col in range(6):
             self.button_frame.columnconfigure(col, weight=1)
         self.button_frame.rowconfigure(0, weight=1)
 
@@ -269,17 +284,21 @@ class RunMode(tkinter.Frame):
         self.run_menu = tkinter.Menu(self.master.menu, tearoff=False)
         self.run_menu.add_command(label="Run", command=self.run_to_halt)
         self.run_menu.add_command(label="Step", command=self.next_step)
+        self.run_menu.add_command(label="Step back", command=self.step_back)
         self.run_menu.add_command(label="Reset", command=self.reset)
         self.menus.append(dict(label="Run", menu=self.run_menu))
 
         self.debug_trace_var = tkinter.BooleanVar()
         self.breakpoints_active_var = tkinter.BooleanVar()
+        self.profile_var = tkinter.BooleanVar()
 
         self.debug_menu = tkinter.Menu(self.master.menu, tearoff=False)
         self.debug_menu.add_checkbutton(label="Debug trace", variable=self.debug_trace_var,
                                         command=self.update_debug_from_vars)
         self.debug_menu.add_checkbutton(label="Breapoints", variable=self.breakpoints_active_var,
                                         command=self.update_debug_from_vars)
+        self.debug_menu.add_checkbutton(label="Profile", variable=self.profile_var,
+                                        command=self.update_profiling)
         self.menus.append(dict(label="Debug", menu=self.debug_menu))
 
         self.breakpoints_active = False
@@ -289,6 +308,8 @@ class RunMode(tkinter.Frame):
 
     def set_code(self, assembler, fname):
         self.runner.load_code(assembler)
+        self.runner.enable_profiling(self.profile_var.get())
+        self.runner.enable_history()
         self.code_editor.update_runner(self.runner)
         self.update_memory()
         self.code_editor.update_syntax()
@@ -299,6 +320,7 @@ class RunMode(tkinter.Frame):
             if not hasattr(self, "runner") or not ok:
                 return False
             self.runner.accumulator.write(num)
+            self.runner.clear_history()
             self.set_colors()
         elif reason == "focusout":
             self.after(0, self.update_memory)
@@ -316,6 +338,7 @@ class RunMode(tkinter.Frame):
             except ValueError:
                 return False
             self.runner.counter = int(num)
+            self.runner.clear_history()
             self.set_colors()
         elif reason == "focusout":
             self.after(0, self.update_memory)
@@ -332,8 +355,34 @@ class RunMode(tkinter.Frame):
             self.run_to_halt = False
             ret = None
         self.give_debug()
+        self.update_memory(self.runner.dirty)
+        self.update_output()
+        return self.handle_halt(ret)
+
+    def step_back(self):
+        self.run_to_halt = False
+        if self.getting_inp:
+            # The INP is undone as well, so it will ask again
+            self.getting_inp = False
+            self.input["state"] = "disabled"
+            self.input_btn["state"] = "disabled"
+        if self.runner.step_back():
+            self.give_output("Stepped back to step {}".format(self.runner.steps), type="debug_jump")
+        self.update_memory()
+        self.update_output()
+
+    def run_chunk(self):
+        try:
+            ret = self.runner.run(max_steps=RUN_CHUNK_STEPS, timeout=RUN_CHUNK_TIME).halt_reason
+        except RuntimeError as e:
+            self.give_output(e.args[0], type="error")
+            self.run_to_halt = False
+            ret = None
         self.update_memory()
         self.update_output()
+        return self.handle_halt(ret)
+
+    def handle_halt(self, ret):
         if ret is runner.HaltReason.hlt:
             self.run_to_halt = False
         elif ret is runner.HaltReason.breakpoint:
@@ -345,7 +394,11 @@ class RunMode(tkinter.Frame):
 
     def run_halt_check(self):
         if self.run_to_halt:
-            self.next_step()
+            # At full speed without a trace there is nothing to see between instructions
+            if self.speed_scale.get() <= self.speed_scale["from"] and not self.show_debug and not self.getting_inp:
+                self.run_chunk()
+            else:
+                self.next_step()
         i = int(self.speed_scale.get() * 1000)
         self.after(i, self.run_halt_check)
 
@@ -369,16 +422,18 @@ class RunMode(tkinter.Frame):
     def pause(self):
         self.run_to_halt = False
 
-    def set_colors(self):
+    def set_colors(self, addresses=None):
+        """Recolor the given addresses, or everything if addresses is None"""
         self.accumulator.config(bg=dbgcodeeditor.COLOR_MAP[self.runner.accumulator.state])
-        self.memory_frame.set_colors(self.runner)
-        self.code_editor.update_syntax()
+        self.memory_frame.set_colors(self.runner, addresses)
+        self.code_editor.update_syntax(addresses)
 
-    def update_memory(self):
-        self.memory_frame.update_memory(self.runner)
+    def update_memory(self, addresses=None):
+        self.memory_frame.update_memory(self.runner, addresses)
         self.accumulator_var.set(str(self.runner.accumulator.value).zfill(3))
         self.counter_var.set(str(self.runner.counter).zfill(3))
-        self.set_colors()
+        self.set_colors(addresses)
+        self.code_editor.update_profile()
 
     def toggle_debug(self):
         if self.show_debug or self.breakpoints_active:
@@ -407,15 +462,17 @@ class RunMode(tkinter.Frame):
         self.update_output()
 
     def give_debug(self):
-        if any(m.state == runner.ValueState.written for m in self.runner.memory):
+        touched = [self.runner.memory[address] for address in self.runner.touched]
+        if any(m.state == runner.ValueState.written for m in touched):
             t = "_write"
-        elif any(m.state == runner.ValueState.read for m in self.runner.memory):
+        elif any(m.state == runner.ValueState.read for m in touched):
             t = "_read"
         elif self.runner.instruction_addr != self.runner.counter - 1:
             t = "_jump"
         else:
             t = "_other"
-        self.all_output.append((self.runner.hint, "debug" + t))
+        # Hints are only rendered in update_output if they are being shown
+        self.all_output.append((self.runner.last_step, "debug" + t))
 
     def update_output(self):
         self.output["state"] = "normal"
@@ -431,6 +488,8 @@ class RunMode(tkinter.Frame):
                     tag = "debug_" + type
                 if type == "output":
                     out(">>> " + text)
+                elif type.startswith("debug_") and isinstance(text, tuple):
+                    out(runner.describe_step(text))
                 elif type.startswith("debug"):
                     out(text)
                 elif type == "input":
@@ -480,8 +539,8 @@ class RunMode(tkinter.Frame):
     def setmem(self, addr, value):
         if self.run_to_halt or self.getting_inp:
             return False
-        self.runner.memory[addr].write(value)
-        self.set_colors()
+        self.runner.write_memory(addr, value)
+        self.set_colors(self.runner.dirty)
         return True
 
     def reset(self):
@@ -489,6 +548,9 @@ class RunMode(tkinter.Frame):
         self.getting_inp = False
         self.all_output = []
         self.runner.reset()
+        if self.runner.profile is not None:
+            self.runner.profile.clear()
+            self.code_editor.update_profile()
         self.set_colors()
         self.update_output()
 
@@ -519,6 +581,10 @@ class RunMode(tkinter.Frame):
         self.update_output()
         self.update_debug_button()
 
+    def update_profiling(self):
+        self.runner.enable_profiling(self.profile_var.get())
+        self.code_editor.show_profile(self.profile_var.get())
+
     def do_bindings(self):
         pass
 
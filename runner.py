@@ -1,4 +1,15 @@
 import enum
+import collections
+import struct
+import sys
+import time
+
+import accelerator
+import compiler
+import cycles
+import history
+import profiler
+import tracefile
 
 
 class BreakpointState(enum.Enum):
@@ -23,6 +34,54 @@ class HaltReason(enum.Enum):
     input = "input"
     step = "step"
     breakpoint = "breakpoint"
+    # The machine went back to a state it had already been in, see Runner.enable_cycle_detection
+    cycle = "cycle"
+    # Only reported by Runner.run, the machine itself is left ready to step
+    step_limit = "step limit"
+    timeout = "timeout"
+    until = "until"
+
+
+# The value states each kind of breakpoint is triggered by
+BREAKPOINT_WATCHES = {
+    BreakpointState.off: (),
+    BreakpointState.on_execute: (ValueState.executed,),
+    BreakpointState.on_read: (ValueState.read,),
+    BreakpointState.on_write: (ValueState.written,),
+    BreakpointState.on_rw: (ValueState.read, ValueState.written),
+    BreakpointState.on_next_execute: (ValueState.next_exec,)
+}
+
+
+class Engine(enum.Enum):
+    normal = "normal"
+    fast = "fast"
+    compiled = "compiled"
+    accelerated = "accelerated"
+
+
+RunSummary = collections.namedtuple("RunSummary", ["steps", "halt_reason", "outputs"])
+
+# Instructions executed between checks of the clock in Runner.run
+RUN_CHUNK = 10000
+
+
+class Snapshot(collections.namedtuple("Snapshot", ["cells", "accumulator", "counter", "halt_reason", "steps"])):
+    """An immutable image of a runner's machine, see Runner.snapshot and Runner.restore"""
+    __slots__ = ()
+    # Accumulator, counter, halt reason, steps and the number of cells, followed by the cells
+    header = struct.Struct("<HHBQH")
+
+    def to_bytes(self):
+        reason = list(HaltReason).index(self.halt_reason)
+        return (self.header.pack(self.accumulator, self.counter, reason, self.steps, len(self.cells))
+                + struct.pack("<{}H".format(len(self.cells)), *self.cells))
+
+    @classmethod
+    def from_bytes(cls, data):
+        accumulator, counter, reason, steps, size = cls.header.unpack_from(data)
+        cells = struct.unpack_from("<{}H".format(size), data, cls.header.size)
+        return cls(cells, accumulator, counter, list(HaltReason)[reason], steps)
 
 
 def int_to_complement(i):
@@ -33,13 +92,57 @@ def int_from_complement(i):
     return i - 1000 if i >= 500 else i
 
 
+def describe_step(step):
+    """Render a Runner.last_step tuple as an English hint"""
+    if step is None:
+        return None
+    opcode, addr, before, after = step
+
+    if opcode == 0:
+        return "HLT"
+    elif opcode == 1:
+        return ("ADD {0:03}: accumulator = {1:03} (accumulator) + "
+                "{2:03} (#{0:03}) = {3:03}".format(addr, before, int_to_complement(after - before), after))
+    elif opcode == 2:
+        return ("SUB {0:03}: accumulator = {1:03} (accumulator) - "
+                "{2:03} (#{0:03}) = {3:03}".format(addr, before, int_to_complement(before - after), after))
+    elif opcode == 3:
+        return "STA {0:03}: store {1:03} (accumulator) to #{0:03}".format(addr, before)
+    elif opcode == 5:
+        return "LDA {0:03}: load {1:03} (#{0:03}) to accumulator".format(addr, after)
+    elif opcode == 6:
+        return "BRA {0:03}: branch to #{0:03}".format(addr)
+    elif opcode == 7:
+        words = ("==", "") if before == 0 else ("!=", " don't")
+        return "BRZ {0:03}: {1:03} (accumulator) {2} 000, so{3} branch to #{0:03}".format(addr, before, *words)
+    elif opcode == 8:
+        words = ("<", "") if before < 500 else (">=", " don't")
+        return "BRP {0:03}: {1:03} (accumulator) {2} 500, so{3} branch to #{0:03}".format(addr, before, *words)
+    elif addr == 1:
+        return "INP"
+    else:
+        return "OUT"
+
+
 class MemoryValue:
-    def __init__(self, address, token=None):
+    def __init__(self, address, token=None, cells=None):
         self.address = address
         self.token = token
         self.state = ValueState.normal
         self.breakpoint = BreakpointState.off
-        self.value = token.machine_instruction() if token else 0
+        # Views over a runner's memory share its cell list, standalone values get their own
+        if cells is None:
+            self.cells, self.index = [token.machine_instruction() if token else 0], 0
+        else:
+            self.cells, self.index = cells, address
+
+    @property
+    def value(self):
+        return self.cells[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.cells[self.index] = value
 
     def reset(self):
         self.value = self.token.machine_instruction() if self.token else 0
@@ -64,18 +167,7 @@ class MemoryValue:
         self.state = ValueState.next_exec
 
     def hit_breakpoint(self):
-        if self.breakpoint == BreakpointState.off:
-            return False
-        elif self.breakpoint == BreakpointState.on_execute:
-            return self.state == ValueState.executed
-        elif self.breakpoint == BreakpointState.on_read:
-            return self.state == ValueState.read
-        elif self.breakpoint == BreakpointState.on_write:
-            return self.state == ValueState.written
-        elif self.breakpoint == BreakpointState.on_rw:
-            return self.state in (ValueState.read, ValueState.written)
-        elif self.breakpoint == BreakpointState.on_next_execute:
-            return self.state == ValueState.next_exec
+        return self.state in BREAKPOINT_WATCHES[self.breakpoint]
 
     def set_interactive(self, tooltip):
         if self.token:
@@ -97,27 +189,117 @@ class MemoryValue:
 
 
 class Runner:
-    def __init__(self, give_output):
+    def __init__(self, give_output, engine=Engine.normal, inputs=None):
         self.give_output = give_output
+        self.engine = Engine(engine)
+        # Where run() takes values from when the program asks for input, see set_inputs
+        self.inputs = None if inputs is None else iter(inputs)
         self.breakpoints_active = False
-        self.memory = []
+        self.cells = []
+        self.tokens = []
+        self._memory = None
+        self.pristine = Snapshot((), 0, 0, HaltReason.step, 0)
         self.accumulator = MemoryValue("accumulator")
-        self.counter = 0
+        self.counter = self.steps = 0
+        # Compiled blocks by start address, for the compiled engine
+        self.blocks = {}
+        self.leaders = set()
+        # Loops that can be fast-forwarded by start address, for the accelerated engine
+        self.loops = {}
+        # Addresses touched by the last instruction, and those whose state changed because of it
+        self.touched = set()
+        self.dirty = set()
+        # (opcode, address, accumulator before, accumulator after) of the last instruction, see describe_last_step
+        self.last_step = None
+        # A profiler.Profile while profiling, see enable_profiling
+        self.profile = None
+        # A history.History while recording what each instruction did, see step_back
+        self.history = None
+        # A tracefile.TraceWriter while tracing, see start_trace
+        self.trace = None
+        # A cycles.CycleDetector while detecting infinite loops, and the cycles.Cycle last found
+        self.detector = None
+        self.cycle = None
+        self.clear_watches()
+
+    @property
+    def memory(self):
+        # The fast engine only works on self.cells, so only build the views when someone wants them
+        if self._memory is None:
+            self._memory = [MemoryValue(i, token, self.cells) for i, token in enumerate(self.tokens)]
+        return self._memory
+
+    @property
+    def breakables(self):
+        return self.memory + [self.accumulator]
 
     def load_code(self, assembler):
         self.assembler = assembler
-        self.memory = []
+        self.pristine = Snapshot((), 0, 0, HaltReason.step, 0)
+        self.cells = []
+        self.tokens = []
+        self._memory = None
+        self.blocks = {}
+        self.loops = {}
+        self.clear_watches()
         self.assembler.assemble()
         if self.assembler.in_error:
             return
-        for i, v in enumerate(self.assembler.instructions):
-            self.memory.append(MemoryValue(i, v))
-        while len(self.memory) < 100:
-            self.memory.append(MemoryValue(len(self.memory)))
-        self.accumulator.reset()
-        self.breakables = self.memory + [self.accumulator]
+        self.cells = list(self.assembler.machine_code)
+        self.tokens = self.assembler.instructions + [None] * (len(self.cells) - len(self.assembler.instructions))
+        self.leaders = self.assembler.analysis.leaders
+        if self.engine is Engine.accelerated:
+            self.loops = accelerator.find_loops(self.cells)
+        # The state straight after loading, which reset() goes back to
+        self.pristine = Snapshot(tuple(self.cells), 0, 0, HaltReason.step, 0)
         self.reset()
 
+    def enable_profiling(self, enabled=True):
+        """
+        Start (or stop) counting executions, reads and writes of each address
+        in self.profile. The counts carry on over resets.
+        """
+        self.profile = profiler.Profile(max(len(self.cells), 100)) if enabled else None
+
+    def enable_history(self, enabled=True, capacity=1000000):
+        """Start (or stop) recording the last capacity instructions, so that they can be undone with step_back"""
+        self.history = history.History(self.steps, capacity) if enabled else None
+
+    def start_trace(self, file):
+        """Write a record of every instruction executed from now on to file (a filename or binary file)"""
+        self.stop_trace()
+        self.trace = tracefile.TraceWriter(file)
+
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def enable_cycle_detection(self, enabled=True):
+        """
+        Start (or stop) halting with HaltReason.cycle when the machine gets
+        back to a state it has been in since the last input, leaving the
+        cycles.Cycle found in self.cycle.
+        """
+        self.detector = cycles.CycleDetector(max(len(self.cells), 100)) if enabled else None
+        self.restart_cycle_detection()
+
+    def restart_cycle_detection(self):
+        # After an input or a change from outside the program, earlier states say nothing about where it goes next
+        if self.detector is not None:
+            self.detector.reset(self.cells, self.steps)
+
+    @property
+    def instrumented(self):
+        # Whether anything needs to know about each instruction, so the fast engines can't be used
+        return (self.profile is not None or self.history is not None or self.trace is not None
+                or self.detector is not None)
+
+    def clear_history(self):
+        # Changes from outside the program aren't recorded, so there is no going back past them
+        if self.history is not None:
+            self.history.clear(self.steps)
+
     def load_breakpoints(self, brps):
         brps = sorted(brps.items())
         for instr in self.assembler.instructions:
@@ -125,27 +307,112 @@ class Runner:
             value.breakpoint = BreakpointState.off
             while brps and brps[0][0] <= instr.position.lineno:
                 value.breakpoint = brps.pop(0)[1]
+        self.compile_breakpoints()
+
+    def clear_watches(self):
+        # Addresses (or "accumulator") watched for each value state
+        self.watches = {state: set() for state in ValueState}
+        self.watching = False
+
+    def compile_breakpoints(self):
+        """Build the watch tables from the breakpoints set on the memory values"""
+        self.clear_watches()
+        for m in self.breakables:
+            for state in BREAKPOINT_WATCHES[m.breakpoint]:
+                self.watches[state].add(m.address)
+        self.watching = any(self.watches.values())
 
     def give_input(self, i):
         if self.halt_reason == HaltReason.input:
             self.accumulator.write(i)
-            self.halt_reason = HaltReason.breakpoint if self.hit_breakpoints() else HaltReason.step
+            if self.trace is not None:
+                self.trace.give_input(self.accumulator.value, i)
+            self.restart_cycle_detection()
+            if self.engine is not Engine.normal:
+                written = "accumulator" in self.watches[ValueState.written]
+                self.halt_reason = HaltReason.breakpoint if written else HaltReason.step
+            else:
+                self.halt_reason = HaltReason.breakpoint if self.hit_breakpoints() else HaltReason.step
+
+    def set_inputs(self, inputs):
+        """Take input from an iterable instead of halting with HaltReason.input, until it runs out"""
+        self.inputs = None if inputs is None else iter(inputs)
+
+    def pull_input(self):
+        # Answer an INP from the input source, returning False if there is nothing to give
+        if self.halt_reason is not HaltReason.input or self.inputs is None:
+            return False
+        for value in self.inputs:
+            self.give_input(value)
+            return True
+        return False
 
     def hit_breakpoints(self):
-        return [m for m in self.breakables if m.hit_breakpoint()]
+        if not self.watching:
+            return []
+        # Only touched values have a state other than normal, so there is no need to look at the rest
+        memory = self.memory
+        touched = [memory[address] for address in sorted(self.touched)] + [self.accumulator]
+        return [m for m in touched if m.address in self.watches[m.state]]
+
+    def _hit_watches(self, instruction, pc):
+        # Work out what the instruction would have touched without needing the value states
+        op, addr = divmod(instruction, 100)
+        if pc in self.watches[ValueState.executed] or pc + 1 in self.watches[ValueState.next_exec]:
+            return True
+        elif op in (1, 2, 5):  # ADD, SUB, LDA
+            return addr in self.watches[ValueState.read] or "accumulator" in self.watches[ValueState.written]
+        elif op == 3:  # STA
+            return addr in self.watches[ValueState.written] or "accumulator" in self.watches[ValueState.read]
+        elif op in (7, 8) or instruction == 902:  # BRZ, BRP, OUT
+            return "accumulator" in self.watches[ValueState.read]
+        return False
+
+    def write_memory(self, address, value):
+        self.clear_history()
+        self.memory[address].write(value)
+        self.restart_cycle_detection()
+        self.touched.add(address)
+        self.dirty = {address}
+
+    @property
+    def hint(self):
+        return self.describe_last_step()
+
+    def describe_last_step(self):
+        """Explain the last instruction executed, in English"""
+        return describe_step(self.last_step)
 
     def next_step(self):
-        for m in self.memory:
-            m.reset_state()
-        instruction = self.memory[self.counter].execute()
+        if self.engine is not Engine.normal:
+            if self.instrumented:
+                self._run_instrumented(1)
+            else:
+                self._run_fast(1)
+            return self.halt_reason
+        memory = self.memory
+        for address in self.touched:
+            memory[address].reset_state()
+        self.dirty = self.touched
+        instruction = memory[self.counter].execute()
         self.instruction_addr = self.counter
         self.counter += 1
-        self.memory[self.counter].next_exec()
+        memory[self.counter].next_exec()
+        self.steps += 1
         addr = instruction % 100
+        self.touched = {self.instruction_addr, self.counter}
+        if 100 <= instruction < 600:  # ADD, SUB, STA and LDA also touch their operand
+            self.touched.add(addr)
+        self.dirty |= self.touched
         self.halt_reason = HaltReason.step
 
+        before = self.accumulator.value
+        if self.history is not None:
+            stores = 300 <= instruction < 400
+            self.history.record(self.instruction_addr, addr if stores else None,
+                                self.cells[addr] if stores else before)
+
         if instruction == 0:  # HLT
-            self.hint = "HLT"
             self.give_output("Done! Coffee break!")
             self.halt_reason = HaltReason.hlt
 
@@ -154,83 +421,413 @@ class Runner:
 
         elif instruction < 200:  # ADD
             memval = self.memory[addr].read()
-            value = int_to_complement(self.accumulator.read() + memval)
-            self.hint = ("ADD {0:03}: accumulator = {1:03} (accumulator) + "
-                         "{2:03} (#{0:03}) = {3:03}".format(addr,
-                                                            self.accumulator.value,
-                                                            memval, value))
-            self.accumulator.write(value)
+            self.accumulator.write(int_to_complement(self.accumulator.read() + memval))
 
         elif instruction < 300:  # SUB
             memval = self.memory[addr].read()
-            value = int_to_complement(self.accumulator.read() - memval)
-            self.hint = ("SUB {0:03}: accumulator = {1:03} (accumulator) - "
-                         "{2:03} (#{0:03}) = {3:03}".format(addr,
-                                                            self.accumulator.value,
-                                                            memval, value))
-            self.accumulator.write(value)
+            self.accumulator.write(int_to_complement(self.accumulator.read() - memval))
 
         elif instruction < 400:  # STA
-            self.hint = ("STA {0:03}: store {1:03} (accumulator) to #{0:03}"
-                         .format(addr, self.accumulator.value))
+            if self.detector is not None:
+                self.detector.store(addr, self.cells[addr], self.accumulator.value)
             self.memory[addr].write(self.accumulator.read())
 
         elif instruction < 500:
             raise RuntimeError("Invalid instruction {:03}".format(instruction))
 
         elif instruction < 600:  # LDA
-            memval = self.memory[addr].read()
-            self.hint = ("LDA {0:03}: load {1:03} (#{0:03}) to accumulator"
-                         .format(addr, memval))
-            self.accumulator.write(memval)
+            self.accumulator.write(self.memory[addr].read())
 
         elif instruction < 700:  # BRA
-            self.hint = "BRA {0:03}: branch to #{0:03}".format(addr)
             self.counter = addr
 
         elif instruction < 800:  # BRZ
-            words = ("==", "") if self.accumulator.read() == 0 else ("!=", " don't")
-            self.hint = ("BRZ {0:03}: {1:03} (accumulator) {2} 000, so{3} branch"
-                         " to #{0:03}".format(addr, self.accumulator.value, *words))
             if self.accumulator.read() == 0:
                 self.counter = addr
 
         elif instruction < 900:  # BRP
-            words = ("<", "") if self.accumulator.read() < 500 else (">=", " don't")
-            self.hint = ("BRP {0:03}: {1:03} (accumulator) {2} 500, so{3} branch to #{0:03}"
-                         .format(addr, self.accumulator.value, *words))
             if self.accumulator.read() < 500:
                 self.counter = addr
 
         elif instruction == 901:  # INP
-            self.hint = "INP"
             self.halt_reason = HaltReason.input
 
         elif instruction == 902:  # OUT
-            self.hint = "OUT"
             self.give_output(int_from_complement(self.accumulator.read()))
 
         else:
             raise RuntimeError("Invalid instruction {:03}".format(instruction))
 
-        if self.halt_reason == HaltReason.step and self.breakpoints_active and self.hit_breakpoints():
+        self.last_step = (instruction // 100, addr, before, self.accumulator.value)
+        if self.profile is not None:
+            self.profile.count(self.instruction_addr, instruction, self.counter)
+        if self.trace is not None:
+            self.trace.record(self.steps, self.instruction_addr, instruction, self.accumulator.value)
+        if (self.history is not None and self.halt_reason is HaltReason.step
+           and not self.steps % self.history.snapshot_interval):
+            self.history.add_snapshot(self.snapshot())
+        if self.detector is not None and 600 <= instruction < 900 and self.counter == addr <= self.instruction_addr:
+            self.cycle = self.detector.back_edge(self.cells, self.accumulator.value, self.counter, self.steps)
+            if self.cycle is not None:
+                self.halt_reason = HaltReason.cycle
+
+        if (self.halt_reason == HaltReason.step and self.breakpoints_active
+           and self.watching and self.hit_breakpoints()):
             self.halt_reason = HaltReason.breakpoint
 
         return self.halt_reason
 
+    def _run_fast(self, max_steps=None):
+        """
+        Execute up to max_steps instructions (or until HLT, INP or a breakpoint)
+        straight off self.cells, without tracking value states. Returns the
+        number of instructions executed.
+        """
+        cells = self.cells
+        give_output = self.give_output
+        watching = self.breakpoints_active and self.watching
+        acc = self.accumulator.value
+        counter = pc = self.counter
+        reason = HaltReason.step
+        steps = 0
+        try:
+            while steps != max_steps:
+                pc = counter
+                instruction = cells[pc]
+                counter = pc + 1
+                before = acc
+                steps += 1
+                op, addr = divmod(instruction, 100)
+                if op == 1:  # ADD
+                    acc = (acc + cells[addr]) % 1000
+                elif op == 2:  # SUB
+                    acc = (acc - cells[addr]) % 1000
+                elif op == 3:  # STA
+                    cells[addr] = acc
+                elif op == 5:  # LDA
+                    acc = cells[addr]
+                elif op == 6:  # BRA
+                    counter = addr
+                elif op == 7:  # BRZ
+                    if acc == 0:
+                        counter = addr
+                elif op == 8:  # BRP
+                    if acc < 500:
+                        counter = addr
+                elif instruction == 902:  # OUT
+                    give_output(int_from_complement(acc))
+                elif instruction == 901:  # INP
+                    reason = HaltReason.input
+                    break
+                elif instruction == 0:  # HLT
+                    give_output("Done! Coffee break!")
+                    reason = HaltReason.hlt
+                    break
+                else:
+                    raise RuntimeError("Invalid instruction {:03}".format(instruction))
+                if watching and self._hit_watches(instruction, pc):
+                    reason = HaltReason.breakpoint
+                    break
+        finally:
+            self.steps += steps
+            self.accumulator.value = acc
+            self.counter = counter
+            if steps:
+                self.instruction_addr = pc
+            self.halt_reason = reason
+        if steps:
+            self.last_step = (op, addr, before, acc)
+        return steps
+
+    def _run_instrumented(self, max_steps=None):
+        """
+        _run_fast, counting each instruction in self.profile, recording it in
+        self.history and self.trace and watching for cycles with
+        self.detector. This is kept separate so that the other engines don't
+        pay anything for them.
+        """
+        cells = self.cells
+        give_output = self.give_output
+        watching = self.breakpoints_active and self.watching
+        profile = self.profile
+        history = self.history
+        trace = self.trace
+        detector = self.detector
+        interval = None if history is None else history.snapshot_interval
+        acc = self.accumulator.value
+        counter = pc = self.counter
+        reason = HaltReason.step
+        base = self.steps
+        steps = 0
+        try:
+            while steps != max_steps:
+                pc = counter
+                instruction = cells[pc]
+                counter = pc + 1
+                before = acc
+                steps += 1
+                op, addr = divmod(instruction, 100)
+                if history is not None:
+                    history.record(pc, addr if op == 3 else None, cells[addr] if op == 3 else acc)
+                if op == 1:  # ADD
+                    acc = (acc + cells[addr]) % 1000
+                elif op == 2:  # SUB
+                    acc = (acc - cells[addr]) % 1000
+                elif op == 3:  # STA
+                    if detector is not None:
+                        detector.store(addr, cells[addr], acc)
+                    cells[addr] = acc
+                elif op == 5:  # LDA
+                    acc = cells[addr]
+                elif op == 6:  # BRA
+                    counter = addr
+                elif op == 7:  # BRZ
+                    if acc == 0:
+                        counter = addr
+                elif op == 8:  # BRP
+                    if acc < 500:
+                        counter = addr
+                elif instruction == 902:  # OUT
+                    give_output(int_from_complement(acc))
+                elif instruction == 901:  # INP
+                    reason = HaltReason.input
+                elif instruction == 0:  # HLT
+                    give_output("Done! Coffee break!")
+                    reason = HaltReason.hlt
+                else:
+                    raise RuntimeError("Invalid instruction {:03}".format(instruction))
+                if detector is not None and counter == addr <= pc and op in (6, 7, 8):
+                    self.cycle = detector.back_edge(cells, acc, counter, base + steps)
+                    if self.cycle is not None:
+                        reason = HaltReason.cycle
+                if profile is not None:
+                    profile.count(pc, instruction, counter)
+                if trace is not None:
+                    trace.record(base + steps, pc, instruction, acc)
+                if reason is not HaltReason.step:
+                    break
+                if history is not None and not (base + steps) % interval:
+                    history.add_snapshot(Snapshot(tuple(cells), acc, counter, HaltReason.step, base + steps))
+                if watching and self._hit_watches(instruction, pc):
+                    reason = HaltReason.breakpoint
+                    break
+        finally:
+            self.steps += steps
+            self.accumulator.value = acc
+            self.counter = counter
+            if steps:
+                self.instruction_addr = pc
+            self.halt_reason = reason
+        if steps:
+            self.last_step = (op, addr, before, acc)
+        return steps
+
+    def _run_compiled(self, max_steps=None):
+        """
+        Like _run_fast, but executes whole compiled blocks at a time, leaving
+        the interpreter to deal with HLT, INP, invalid instructions and the
+        last few instructions before max_steps. The accelerated engine also
+        fast-forwards the loops found by accelerator.find_loops.
+        """
+        if self.breakpoints_active and self.watching:
+            return self._run_fast(max_steps)
+        cells = self.cells
+        blocks = self.blocks
+        leaders = self.leaders
+        loops = self.loops if self.engine is Engine.accelerated else {}
+        give_output = self.give_output
+        acc = self.accumulator.value
+        counter = self.counter
+        steps = 0
+        last = None
+        try:
+            while True:
+                loop = loops.get(counter)
+                if loop is not None and loop.valid(cells):
+                    budget = sys.maxsize if max_steps is None else max_steps - steps
+                    acc, executed = loop.function(cells, acc, budget)
+                    if executed:
+                        steps += executed
+                        before = acc
+                        last = loop
+                block = blocks.get(counter)
+                if block is None or not block.valid(cells):
+                    block = compiler.compile_block(cells, counter, leaders)
+                    if block is None:
+                        break
+                    blocks[counter] = block
+                budget = sys.maxsize if max_steps is None else max_steps - steps
+                if block.length > budget:
+                    break
+                acc, before, counter, executed = block.function(cells, acc, give_output, budget)
+                steps += executed
+                last = block
+        finally:
+            self.steps += steps
+            self.accumulator.value = acc
+            self.counter = counter
+            self.halt_reason = HaltReason.step
+            if last is not None:
+                self.instruction_addr = last.end - 1
+                self.last_step = (last.last // 100, last.last % 100, before, acc)
+        return steps + self._run_fast(1 if max_steps is None else max_steps - steps)
+
+    def _run_normal(self, max_steps=None):
+        steps = 0
+        while steps != max_steps:
+            steps += 1
+            if self.next_step() is not HaltReason.step:
+                break
+        return steps
+
+    def run(self, max_steps=None, until=None, timeout=None):
+        """
+        Run until HLT, INP or a breakpoint, or until max_steps instructions have
+        been executed, timeout seconds have passed or until(runner) returns
+        True after an instruction. Input is taken from the input source while
+        it lasts. Returns a RunSummary of the steps executed, why it stopped
+        and the values output.
+        """
+        if self.halt_reason is HaltReason.hlt:
+            # Carrying on would run whatever is in the cell after the HLT
+            return RunSummary(0, HaltReason.hlt, [])
+        run_steps = {Engine.normal: self._run_normal,
+                     Engine.fast: self._run_fast,
+                     Engine.compiled: self._run_compiled,
+                     Engine.accelerated: self._run_compiled}[self.engine]
+        if self.instrumented and self.engine is not Engine.normal:
+            run_steps = self._run_instrumented
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        if until is not None:
+            chunk = 1
+        elif deadline is not None:
+            chunk = RUN_CHUNK
+        else:
+            chunk = None
+
+        outputs = []
+        give_output = self.give_output
+
+        def collect(value):
+            if isinstance(value, int):
+                outputs.append(value)
+            if give_output is not None:
+                give_output(value)
+
+        self.give_output = collect
+        steps = 0
+        reason = HaltReason.step
+        try:
+            while reason is HaltReason.step:
+                if max_steps is not None:
+                    if steps >= max_steps:
+                        reason = HaltReason.step_limit
+                        break
+                    chunk = max_steps - steps if chunk is None else min(chunk, max_steps - steps)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    reason = HaltReason.timeout
+                    break
+                steps += run_steps(chunk)
+                self.pull_input()
+                reason = self.halt_reason
+                if reason is HaltReason.step and until is not None and until(self):
+                    reason = HaltReason.until
+        finally:
+            self.give_output = give_output
+        return RunSummary(steps, reason, outputs)
+
+    def iter_outputs(self, max_steps=None, timeout=None):
+        """
+        Run the program, yielding the values it outputs as it goes. Stops at
+        HLT, a breakpoint, when there is no input left to give it, or when
+        max_steps or timeout runs out.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        steps = 0
+        while True:
+            chunk = RUN_CHUNK if max_steps is None else min(RUN_CHUNK, max_steps - steps)
+            summary = self.run(max_steps=chunk, timeout=deadline and deadline - time.perf_counter())
+            steps += summary.steps
+            yield from summary.outputs
+            if summary.halt_reason is not HaltReason.step_limit or steps == max_steps:
+                return
+
     def run_to_hlt(self):
-        r = HaltReason.step
-        while r in (HaltReason.step, HaltReason.breakpoint):
-            r = self.next_step()
-        return r
+        while self.run().halt_reason is HaltReason.breakpoint:
+            pass
+        return self.halt_reason
+
+    def snapshot(self):
+        """Take an immutable Snapshot of the memory, accumulator, counter, halt reason and steps"""
+        return Snapshot(tuple(self.cells), self.accumulator.value, self.counter, self.halt_reason, self.steps)
+
+    def restore(self, snapshot):
+        """Put the machine back into the state of a Snapshot taken of it (or the same program)"""
+        self._restore(snapshot)
+        self.clear_history()
+
+    def _restore(self, snapshot):
+        self.cells[:] = snapshot.cells
+        self.accumulator.value = snapshot.accumulator
+        self.accumulator.reset_state()
+        self.counter = self.instruction_addr = snapshot.counter
+        self.halt_reason = snapshot.halt_reason
+        self.steps = snapshot.steps
+        self.last_step = None
+        self.touched = set()
+        self.refresh_states()
+        self.restart_cycle_detection()
+
+    def refresh_states(self):
+        # Forget the value states, after the machine has been changed wholesale
+        self.touched = set()
+        self.dirty = set(range(len(self.cells)))
+        if self.engine is Engine.normal or self._memory is not None:
+            for m in self.memory:
+                m.reset_state()
+            if self.counter < len(self.memory):
+                self.memory[self.counter].next_exec()
+                self.touched.add(self.counter)
 
     def reset(self):
-        self.counter = self.instruction_addr = 0
+        self.restore(self.pristine)
+
+    def step_back(self, n=1):
+        """
+        Undo the last n instructions, or as many as have been recorded since
+        history was enabled. Returns the number undone. Outputs can't be taken
+        back, and inputs taken from an input source aren't given again.
+        """
+        if self.history is None:
+            return 0
+        undone = min(n, len(self.history))
+        target = self.steps - undone
+        if not undone:
+            return 0
+        # Going back to a later snapshot first leaves fewer entries to undo
+        snapshot = self.history.nearest_snapshot(target)
+        if snapshot is not None and snapshot.steps < self.steps:
+            self.history.truncate(snapshot.steps)
+            self._restore(snapshot)
+        cells, accumulator = self.cells, self.accumulator
+        while self.steps > target:
+            entry = self.history.pop()
+            if entry.address is None:
+                accumulator.value = entry.old
+            else:
+                cells[entry.address] = entry.old
+            self.counter = entry.pc
+            self.steps -= 1
+        self.history.truncate(target)
+        # Another instruction was executed after this point, so the machine was running
         self.halt_reason = HaltReason.step
-        self.accumulator.reset()
-        for m in self.memory:
-            m.reset()
-        self.memory[self.counter].next_exec()
+        entry = self.history.peek()
+        self.instruction_addr = self.counter if entry is None else entry.pc
+        self.last_step = None
+        accumulator.reset_state()
+        self.refresh_states()
+        self.restart_cycle_detection()
+        return undone
 
 if __name__ == "__main__":
     import sys
@@ -242,6 +839,7 @@ if __name__ == "__main__":
     runner.load_code(assem)
     runner.accumulator.breakpoint = BreakpointState.on_write
     runner.memory[44].breakpoint = BreakpointState.on_read
+    runner.compile_breakpoints()
     for m in runner.memory:
         print(m.breakpoint)
     while runner.halt_reason != HaltReason.hlt:
@@ -0,0 +1,203 @@
+"""
+Execution server: assembles and runs programs for clients talking JSON lines
+over a TCP or Unix socket. Assembled programs are kept by the hash of their
+code, and running is done by a pool of worker processes, each keeping warm
+runners for the programs it has seen.
+
+Each request is a JSON object on a line of its own, with an "op" of:
+    assemble  "code"; gives "program" (the hash to run it by), "problems"
+              and "machine_code"
+    run       "program" or "code", and optionally "inputs", "max_steps",
+              "timeout", "engine" and "detect_loops"; gives a result as
+              harness.run_case does, with "run_time" the time spent running
+    step      as run, continuing from the "state" given by an earlier step
+              if there is one; also gives the new "state"
+Responses are JSON lines with the request's "id", "ok", "time" taken and an
+"error" if something went wrong. Requests on a connection are handled
+concurrently, so responses can come back in a different order.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import signal
+import time
+
+import assembler
+import harness
+import runner
+
+logger = logging.getLogger(__name__)
+
+# Programs kept by the server, and warm runners kept by each worker
+PROGRAMS = 256
+RUNNERS_PER_WORKER = 64
+# Longest request line accepted
+LINE_LIMIT = 1 << 20
+
+# The warm runners of the current worker process, by (program, engine, detect_loops)
+_runners = collections.OrderedDict()
+
+
+def _runner_for(program, code, engine, detect_loops):
+    key = (program, engine, detect_loops)
+    run = _runners.get(key)
+    if run is not None:
+        _runners.move_to_end(key)
+        return run
+    assem = assembler.Assembler()
+    assem.update_code(code)
+    run = runner.Runner(None, engine=engine)
+    run.load_code(assem)
+    if assem.in_error:
+        raise ValueError("Assembly failed")
+    run.enable_cycle_detection(detect_loops)
+    _runners[key] = run
+    while len(_runners) > RUNNERS_PER_WORKER:
+        _runners.popitem(last=False)
+    return run
+
+
+def execute(program, code, request):
+    """Carry out a run or step request in a worker process, returning the response"""
+    start = time.perf_counter()
+    run = _runner_for(program, code, runner.Engine(request["engine"]), bool(request.get("detect_loops")))
+    state = request.get("state")
+    if state is None:
+        run.reset()
+    else:
+        run.restore(runner.Snapshot(tuple(state["cells"]), state["accumulator"], state["counter"],
+                                    runner.HaltReason(state["halt_reason"]), state["steps"]))
+    record = harness.execute(run, request.get("inputs", []), request.get("max_steps"), request.get("timeout"))
+    response = harness.case_result(request, record, time.perf_counter() - start)
+    response["run_time"] = response.pop("time")
+    if request["op"] == "step":
+        snapshot = run.snapshot()
+        response["state"] = dict(snapshot._asdict(), cells=list(snapshot.cells),
+                                 halt_reason=snapshot.halt_reason.value)
+    return response
+
+
+class Server:
+    def __init__(self, engine=runner.Engine.fast, jobs=None, detect_loops=False):
+        self.engine = runner.Engine(engine)
+        self.detect_loops = detect_loops
+        self.jobs = jobs
+        # (code, assembler) by program hash, most recently used last
+        self.programs = collections.OrderedDict()
+        self.executor = None
+
+    def program(self, code):
+        """Assemble code, or find it already assembled, returning (program hash, assembler)"""
+        program = hashlib.sha256(code.encode()).hexdigest()
+        if program in self.programs:
+            self.programs.move_to_end(program)
+        else:
+            assem = assembler.Assembler()
+            assem.update_code(code)
+            assem.assemble()
+            self.programs[program] = (code, assem)
+            while len(self.programs) > PROGRAMS:
+                self.programs.popitem(last=False)
+        return program, self.programs[program][1]
+
+    async def handle(self, request):
+        op = request.get("op")
+        if op == "assemble":
+            program, assem = self.program(request["code"])
+            code = assem.code
+            response = {"ok": not assem.in_error,
+                        "program": program,
+                        "problems": [problem.show(code) for problem in assem.problems]}
+            if assem.in_error:
+                response["error"] = "Assembly failed"
+            else:
+                response["machine_code"] = assem.machine_code[:assem.machine_code_length]
+            return response
+        elif op in ("run", "step"):
+            if "code" in request:
+                program, assem = self.program(request["code"])
+            elif request.get("program") in self.programs:
+                program, (_, assem) = request["program"], self.programs[request["program"]]
+            else:
+                return {"ok": False, "error": "Unknown program, send its code"}
+            if assem.in_error:
+                return {"ok": False, "program": program, "error": "Assembly failed"}
+            code = self.programs[program][0]
+            request = dict(request, engine=request.get("engine", self.engine.value),
+                           detect_loops=request.get("detect_loops", self.detect_loops))
+            request.pop("code", None)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self.executor, execute, program, code, request)
+            return dict(response, ok=True, program=program)
+        return {"ok": False, "error": "Unknown op {!r}".format(op)}
+
+    async def respond(self, line, writer):
+        start = time.perf_counter()
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            response = await self.handle(request)
+        except Exception as e:
+            logger.info("Request failed: {!r}", e)
+            response = {"ok": False, "error": str(e) or e.__class__.__name__}
+        response["id"] = request_id
+        response["time"] = time.perf_counter() - start
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+
+    async def serve_client(self, reader, writer):
+        logger.info("Client connected")
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self.respond(line, writer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except (ConnectionError, ValueError) as e:
+            logger.info("Client dropped: {!r}", e)
+        except asyncio.CancelledError:
+            # The server is shutting down
+            pass
+        finally:
+            writer.close()
+        logger.info("Client disconnected")
+
+    async def serve(self, address):
+        """Serve on address, host:port for TCP or the path of a Unix socket, until cancelled or terminated"""
+        try:
+            # Stop cleanly on SIGTERM, so that the workers are shut down too
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+        unix = not (":" in address and os.path.sep not in address)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        try:
+            if unix:
+                server = await asyncio.start_unix_server(self.serve_client, address, limit=LINE_LIMIT)
+            else:
+                host, port = address.rsplit(":", 1)
+                server = await asyncio.start_server(self.serve_client, host or None, int(port), limit=LINE_LIMIT)
+            logger.info("Serving on {}", address)
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if unix and os.path.exists(address):
+                os.unlink(address)
+
+
+def serve(address, engine=runner.Engine.fast, jobs=None, detect_loops=False):
+    asyncio.run(Server(engine, jobs, detect_loops).serve(address))
@@ -20,11 +20,17 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import tkinter
 from tkinter import (filedialog as fdialog, scrolledtext as stext,
                      simpledialog, font as tkfont)
+import json
 import logging
 import sys
+import time
 
-import assembler
+import cycles
+import harness
+import objectcache
+import resultcache
 import runner
+import server
 import codemode
 import runmode
 import colored_logger
@@ -120,6 +126,21 @@ def main_gui(args_from_parser, exc_reporter):
     return 0
 
 
+def object_cache(args_from_parser):
+    """The object cache to assemble through, or None if it is turned off"""
+    if args_from_parser.no_object_cache:
+        return None
+    return objectcache.ObjectCache(args_from_parser.object_cache)
+
+
+def assemble(code, args_from_parser):
+    objects = object_cache(args_from_parser)
+    assem = objectcache.assemble(code, objects)
+    if objects is not None:
+        objects.close()
+    return assem
+
+
 def main_cli(args_from_parser, exc_reporter):
     if len(args_from_parser.file) > 1:
         print("Too many files")
@@ -131,11 +152,10 @@ def main_cli(args_from_parser, exc_reporter):
         print("Could not open file:", e)
         return 1
     print("Assembling...")
-    assem = assembler.Assembler()
-    assem.update_code(code)
-    assem.assemble()
-    if assem.problems:
-        print("\n".join(i.show(code.splitlines()) for i in assem.problems))
+    assem = assemble(code, args_from_parser)
+    if assem.problem_index:
+        print("\n".join(problem.show(code.splitlines()) for problem in assem.problem_index))
+        print(assem.problem_index.summary())
     if assem.in_error:
         print("Assembly failed")
         return 1
@@ -146,20 +166,35 @@ def main_cli(args_from_parser, exc_reporter):
         print("Code:")
         print(" ".join(map(str, machine_code[:code_length])))
     print("Loading code...")
-    run = runner.Runner(lambda x: print(">>>", x))
+    run = runner.Runner(lambda x: print(">>>", x), engine=args_from_parser.engine)
     run.load_code(assem)
+    if args_from_parser.profile:
+        run.enable_profiling()
+    if args_from_parser.trace:
+        run.start_trace(args_from_parser.trace)
+    if args_from_parser.detect_loops:
+        run.enable_cycle_detection()
+    max_steps = args_from_parser.max_steps
+    deadline = None if args_from_parser.timeout is None else time.perf_counter() + args_from_parser.timeout
     print("Running...")
     while run.halt_reason != runner.HaltReason.hlt:
+        if ((max_steps is not None and run.steps >= max_steps)
+           or (deadline is not None and time.perf_counter() >= deadline)):
+            print("Stopped after {} steps".format(run.steps))
+            break
         if args_from_parser.debug >= 2:
-            print("Memory:")
-            print(*[i.value for i in run.memory])
-            print("Executing instruction {:03} at {:03}".format(run.memory[run.counter].value, run.counter))
+            print("Executing instruction {:03} at {:03}".format(run.cells[run.counter], run.counter))
         try:
-            run.next_step()
+            # Without debug output there is no need to come back after every instruction
+            run.run(max_steps=1 if args_from_parser.debug else max_steps and max_steps - run.steps,
+                    timeout=deadline and deadline - time.perf_counter())
         except RuntimeError as e:
             print("Error", e.args[0])
         except (KeyboardInterrupt, EOFError):
             break
+        if run.halt_reason is runner.HaltReason.cycle:
+            print(cycles.describe_cycle(run.cycle))
+            break
         if run.halt_reason == runner.HaltReason.input:
             try:
                 run.give_input(int(input("<<< ")))
@@ -167,6 +202,145 @@ def main_cli(args_from_parser, exc_reporter):
                 break
         if args_from_parser.debug >= 1:
             print(run.hint)
+    run.stop_trace()
+    if args_from_parser.profile:
+        print(run.profile.report(assem, run.cells))
+    return 0
+
+
+def read_ints(f):
+    for line in f:
+        for word in line.split():
+            yield int(word)
+
+
+def main_raw(args_from_parser, exc_reporter):
+    if len(args_from_parser.file) != 1:
+        print("Raw mode needs exactly one file", file=sys.stderr)
+        return 1
+    try:
+        with open(args_from_parser.file[0]) as f:
+            code = f.read()
+    except IOError as e:
+        print("Could not open file:", e, file=sys.stderr)
+        return 1
+    assem = assemble(code, args_from_parser)
+    if assem.in_error:
+        print("\n".join(problem.show(code.splitlines()) for problem in assem.problem_index), file=sys.stderr)
+        print("Assembly failed", file=sys.stderr)
+        return 1
+    inputs = read_ints(sys.stdin)
+    cache = key = None
+    if args_from_parser.cache:
+        # The whole of the input is part of the key, so it can't be streamed
+        try:
+            inputs = list(inputs)
+        except ValueError as e:
+            print("Bad input:", e, file=sys.stderr)
+            return 1
+        cache = resultcache.ResultCache(args_from_parser.cache)
+        key = resultcache.result_key(assem.machine_code, inputs, args_from_parser.max_steps,
+                                     args_from_parser.detect_loops)
+        # A cached result has nothing to profile or trace
+        record = None if args_from_parser.profile or args_from_parser.trace else cache.get(key)
+        if record is not None:
+            sys.stdout.write("".join("{}\n".format(value) for value in record["outputs"]))
+            sys.stdout.flush()
+            cache.close()
+            print("Cache:", cache.stats(), file=sys.stderr)
+            return report_raw(record)
+    run = runner.Runner(None, engine=args_from_parser.engine)
+    run.load_code(assem)
+    if args_from_parser.profile:
+        run.enable_profiling()
+    if args_from_parser.trace:
+        run.start_trace(args_from_parser.trace)
+    if args_from_parser.detect_loops:
+        run.enable_cycle_detection()
+    # Output is left to stdout's buffering, rather than flushing every value
+    write = sys.stdout.write
+    try:
+        record = harness.execute(run, inputs, args_from_parser.max_steps, args_from_parser.timeout,
+                                 output=lambda value: write("{}\n".format(value)), keep_outputs=cache is not None)
+    except ValueError as e:
+        print("Bad input:", e, file=sys.stderr)
+        return 1
+    finally:
+        sys.stdout.flush()
+        run.stop_trace()
+        if args_from_parser.profile:
+            print(run.profile.report(assem, run.cells), file=sys.stderr)
+    if cache is not None:
+        # How far a program gets before a timeout depends on the machine, so it can't be reused
+        if record["halt_reason"] != runner.HaltReason.timeout.value:
+            cache.put(key, record)
+        cache.close()
+        print("Cache:", cache.stats(), file=sys.stderr)
+    return report_raw(record)
+
+
+def report_raw(record):
+    if "error" in record:
+        print("Error", record["error"], file=sys.stderr)
+        return 1
+    elif record["halt_reason"] == runner.HaltReason.input.value:
+        print("Ran out of input", file=sys.stderr)
+        return 1
+    elif record["halt_reason"] == runner.HaltReason.cycle.value:
+        print(cycles.describe_cycle(cycles.Cycle(**record["cycle"])), file=sys.stderr)
+        return 1
+    elif record["halt_reason"] != runner.HaltReason.hlt.value:
+        print("Stopped after {} steps".format(record["steps"]), file=sys.stderr)
+        return 1
+    return 0
+
+
+def main_batch(args_from_parser, exc_reporter):
+    if len(args_from_parser.file) != 1:
+        print("Batch mode needs exactly one file", file=sys.stderr)
+        return 1
+    try:
+        with open(args_from_parser.file[0]) as f:
+            code = f.read()
+        cases = harness.load_cases(args_from_parser.batch)
+    except (IOError, ValueError, KeyError) as e:
+        print("Could not load files:", e, file=sys.stderr)
+        return 1
+    objects = object_cache(args_from_parser)
+    assem = objectcache.assemble(code, objects)
+    if assem.in_error:
+        print("\n".join(problem.show(code.splitlines()) for problem in assem.problem_index), file=sys.stderr)
+        print("Assembly failed", file=sys.stderr)
+        return 1
+    passed = 0
+    cache = resultcache.ResultCache(args_from_parser.cache) if args_from_parser.cache else None
+    try:
+        for result in harness.run_batch(code, cases, engine=args_from_parser.engine,
+                                        max_steps=args_from_parser.max_steps,
+                                        timeout=args_from_parser.timeout, jobs=args_from_parser.jobs,
+                                        detect_loops=args_from_parser.detect_loops, cache=cache,
+                                        objects=objects):
+            passed += result["passed"]
+            print(json.dumps(result), flush=True)
+    finally:
+        if cache is not None:
+            cache.close()
+            print("Cache:", cache.stats(), file=sys.stderr)
+        if objects is not None:
+            objects.close()
+    print("{}/{} passed".format(passed, len(cases)), file=sys.stderr)
+    return 0 if passed == len(cases) else 1
+
+
+def main_serve(args_from_parser, exc_reporter):
+    try:
+        server.serve(args_from_parser.serve, engine=args_from_parser.engine, jobs=args_from_parser.jobs,
+                     detect_loops=args_from_parser.detect_loops)
+    except OSError as e:
+        print("Could not serve:", e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
     return 0
 
 
@@ -197,6 +371,35 @@ under certain conditions. Type `specter --licence` for details.
     cli_group.add_argument("-d", "--debug", help="debug level"
                            " (repeat for more info, 3 is the max)",
                            action="count", default=0)
+    cli_group.add_argument("-e", "--engine", help="execution engine",
+                           choices=[e.value for e in runner.Engine],
+                           default=runner.Engine.normal.value)
+    cli_group.add_argument("-s", "--max-steps", help="stop after this many"
+                           " instructions", type=int)
+    cli_group.add_argument("-t", "--timeout", help="stop after this many"
+                           " seconds", type=float)
+    cli_group.add_argument("-r", "--raw", "--stdin", help="read whitespace separated"
+                           " inputs from stdin and write plain outputs to stdout", action="store_true")
+    cli_group.add_argument("-p", "--profile", help="print how often each"
+                           " instruction was executed and the hottest loops", action="store_true")
+    cli_group.add_argument("--trace", help="write a binary trace of every"
+                           " instruction executed to this file (read it with tracefile.py)", metavar="FILE")
+    cli_group.add_argument("--detect-loops", help="stop when the program"
+                           " gets stuck in a loop it can never leave", action="store_true")
+    cli_group.add_argument("--cache", help="reuse the results of earlier runs"
+                           " of the same code over the same inputs, kept in this file (--raw and --batch only)",
+                           metavar="FILE")
+    cli_group.add_argument("--object-cache", help="keep assembled programs"
+                           " in this directory, so that unchanged code isn't assembled again"
+                           " (default: %(default)s)", default=objectcache.DEFAULT_DIRECTORY, metavar="DIR")
+    cli_group.add_argument("--no-object-cache", help="always assemble from"
+                           " scratch", action="store_true")
+    cli_group.add_argument("-b", "--batch", help="run the test cases in this"
+                           " JSON file and print the results as JSON lines", metavar="CASES")
+    cli_group.add_argument("-j", "--jobs", help="worker processes for --batch"
+                           " and --serve (default: one per CPU)", type=int)
+    cli_group.add_argument("--serve", help="serve assemble and run requests as"
+                           " JSON lines on host:port or a Unix socket path (see server.py)", metavar="ADDRESS")
 
     args_from_parser = arg_parser.parse_args()
 
@@ -209,7 +412,8 @@ under certain conditions. Type `specter --licence` for details.
 
     stream_hndlr = logging.StreamHandler(sys.stdout)
     stream_hndlr.setFormatter(log_formatter)
-    stream_hndlr.setLevel(logging.CRITICAL if args_from_parser.cli else logging.INFO)
+    quiet = args_from_parser.cli or args_from_parser.batch or args_from_parser.raw
+    stream_hndlr.setLevel(logging.CRITICAL if quiet else logging.INFO)
     logger.addHandler(stream_hndlr)
 
     try:
@@ -251,7 +455,13 @@ under certain conditions. Type `specter --licence` for details.
             exc_catcher.handlers.append(tk_h)
         exc_catcher.enabled = args_from_parser.nobuginfo
 
-    if args_from_parser.cli:
+    if args_from_parser.serve:
+        exit(main_serve(args_from_parser, exc_catcher))
+    elif args_from_parser.batch:
+        exit(main_batch(args_from_parser, exc_catcher))
+    elif args_from_parser.raw:
+        exit(main_raw(args_from_parser, exc_catcher))
+    elif args_from_parser.cli:
         exit(main_cli(args_from_parser, exc_catcher))
     else:
         exit(main_gui(args_from_parser, exc_catcher))
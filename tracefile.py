@@ -0,0 +1,157 @@
+"""
+Binary execution traces. A trace is a short header followed by one fixed width
+record per instruction executed: the step number, the address executed, the
+opcode and operand, the accumulator afterwards, and any input, output or halt
+that happened. TraceWriter streams them out for Runner.start_trace, and
+TraceReader memory-maps a trace to replay or search it.
+"""
+import collections
+import enum
+import mmap
+import struct
+
+MAGIC = b"LMCT"
+VERSION = 1
+
+# Magic, version, record size
+HEADER = struct.Struct("<4sBB")
+# Step, address, opcode, operand, accumulator after, event, value input or output
+RECORD = struct.Struct("<IHBBHBh")
+# Where the opcode (followed by the operand) is within a record
+OPCODE_OFFSET = 6
+# Records unpacked at a time when iterating
+ITER_CHUNK = 65536
+
+Record = collections.namedtuple("Record", ["step", "pc", "opcode", "operand", "accumulator", "event", "value"])
+
+
+class Event(enum.Enum):
+    none = 0
+    output = 1
+    input = 2
+    halt = 3
+    # The trace ended while the INP was waiting for its input
+    waiting = 4
+
+
+class TraceWriter:
+    def __init__(self, file, buffer_size=1 << 20):
+        """file is a filename or a binary file object"""
+        self.owns_file = isinstance(file, str)
+        self.file = open(file, "wb", buffering=buffer_size) if self.owns_file else file
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.pack = RECORD.pack
+        # An INP is only written once it has its input
+        self.pending = None
+
+    def record(self, step, pc, instruction, accumulator):
+        """Record the instruction at pc, which was the step'th, leaving the accumulator at accumulator"""
+        opcode, operand = divmod(instruction, 100)
+        if instruction == 902:
+            event, value = Event.output.value, accumulator - 1000 if accumulator >= 500 else accumulator
+        elif instruction == 901:
+            self.pending = step, pc
+            return
+        elif instruction == 0:
+            event, value = Event.halt.value, 0
+        else:
+            event = value = 0
+        self.file.write(self.pack(step, pc, opcode, operand, accumulator, event, value))
+
+    def give_input(self, accumulator, value):
+        if self.pending is not None:
+            step, pc = self.pending
+            self.pending = None
+            self.file.write(self.pack(step, pc, 9, 1, accumulator, Event.input.value, value))
+
+    def close(self):
+        if self.pending is not None:
+            step, pc = self.pending
+            self.pending = None
+            self.file.write(self.pack(step, pc, 9, 1, 0, Event.waiting.value, 0))
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class TraceReader:
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError("{} is not a version {} trace".format(fname, VERSION))
+        self.length = (len(self.map) - HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("Record index out of range")
+        return Record(*RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size))
+
+    def __iter__(self):
+        for start in range(0, self.length, ITER_CHUNK):
+            end = min(start + ITER_CHUNK, self.length)
+            for fields in RECORD.iter_unpack(self.map[HEADER.size + start * RECORD.size:
+                                                      HEADER.size + end * RECORD.size]):
+                yield Record(*fields)
+
+    def close(self):
+        self.map.close()
+
+    def outputs(self):
+        return [record.value for record in self if record.event == Event.output.value]
+
+    def search(self, opcode, operand, before=None):
+        """
+        The index of the last record of an instruction with the given opcode
+        and operand, before the record at index before, or None.
+        """
+        pattern = bytes((opcode, operand))
+        end = HEADER.size + (self.length if before is None else min(before, self.length)) * RECORD.size
+        while True:
+            # Searching the raw bytes is far quicker than unpacking every record, but needs an alignment check
+            found = self.map.rfind(pattern, HEADER.size, end)
+            if found == -1:
+                return None
+            index, offset = divmod(found - HEADER.size, RECORD.size)
+            if offset == OPCODE_OFFSET:
+                return index
+            end = found + 1
+
+    def last_write(self, address, before=None):
+        """The last Record of a STA to address (before the record at index before), or None"""
+        index = self.search(3, address, before)
+        return None if index is None else self[index]
+
+    def replay(self, machine_code):
+        """
+        Re-run the trace over a copy of machine_code, yielding each Record with
+        the memory as it was after that instruction.
+        """
+        cells = list(machine_code)
+        for record in self:
+            if record.opcode == 3:
+                cells[record.operand] = record.accumulator
+            yield record, cells
+
+
+if __name__ == "__main__":
+    import sys
+    reader = TraceReader(sys.argv[1])
+    if len(sys.argv) > 2:
+        for address in map(int, sys.argv[2:]):
+            record = reader.last_write(address)
+            if record is None:
+                print("{:03} was never written".format(address))
+            else:
+                print("{:03} was last written at step {} by {:03}".format(address, record.step, record.pc))
+    else:
+        for record in reader:
+            print("{:>8} {:03} {}{:02} acc={:03} {}".format(record.step, record.pc, record.opcode, record.operand,
+                                                           record.accumulator, Event(record.event).name))